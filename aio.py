@@ -0,0 +1,220 @@
+"""
+asyncio versions of the common srusers operations.
+
+Operations are sent to the server using python-ldap's message id based
+calls (``search_ext``, ``add_ext`` etc.) and their results are collected
+as they arrive, so many operations can be in flight at once over a small
+number of connections.
+
+This module needs Python 3, and so isn't imported by the package itself.
+"""
+
+import asyncio
+import ldap
+
+from . import cache
+from . import membership
+from . import roster
+from . import sr_ldap
+from . import groups as _groups
+from . import users as _users
+from .sr_ldap import ensure_text
+
+class Directory(object):
+    """A few connections to the LDAP server, over which any number of
+    operations may be outstanding."""
+
+    def __init__(self, size = 2, poll_interval = 0.05):
+        self.size = size
+        self.poll_interval = poll_interval
+
+        self._conns = []
+        # Outstanding operations for each connection, msgid -> future
+        self._pending = {}
+        self._timer = None
+        self._loop = None
+
+    async def open(self):
+        "Bind and open the connections"
+        self._loop = asyncio.get_event_loop()
+
+        if not await self._loop.run_in_executor(None, sr_ldap.bind) and not sr_ldap.bound:
+            raise ldap.INVALID_CREDENTIALS({'desc': "Could not bind to the LDAP server"})
+
+        for i in range(self.size):
+            conn = await self._loop.run_in_executor(None, sr_ldap.get_backend().open_connection)
+            self._conns.append(conn)
+            self._pending[id(conn)] = {}
+
+            try:
+                self._loop.add_reader(conn.fileno(), self.__poll, conn)
+            except (NotImplementedError, AttributeError):
+                # Not all event loops can watch sockets; fall back to the timer
+                pass
+
+    def close(self):
+        "Close the connections, failing any outstanding operations"
+        for conn in self._conns:
+            try:
+                self._loop.remove_reader(conn.fileno())
+            except (NotImplementedError, AttributeError, ValueError):
+                pass
+
+            for future in self._pending.pop(id(conn)).values():
+                if not future.done():
+                    future.cancel()
+
+            sr_ldap.get_backend().close_connection(conn)
+
+        self._conns = []
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def submit(self, start):
+        """Start an operation on the least busy connection. ``start`` is
+        called with the connection and must return the operation's msgid.
+        Returns a future for the (type, data, controls) of the result."""
+        conn = min(self._conns, key = lambda c: len(self._pending[id(c)]))
+        msgid = start(conn)
+
+        future = self._loop.create_future()
+        self._pending[id(conn)][msgid] = future
+        self.__schedule()
+        return future
+
+    async def search(self, base, scope, filterstr, attrlist = None):
+        rtype, rdata, ctrls = await self.submit(
+            lambda conn: conn.search_ext( base, scope, filterstr, attrlist ) )
+        return rdata
+
+    async def add(self, dn, modlist):
+        await self.submit( lambda conn: conn.add_ext( dn, modlist ) )
+
+    async def modify(self, dn, modlist):
+        await self.submit( lambda conn: conn.modify_ext( dn, modlist ) )
+
+    async def delete(self, dn):
+        await self.submit( lambda conn: conn.delete_ext( dn ) )
+
+    def __schedule(self):
+        "Make sure there's a poll coming up while operations are outstanding"
+        if self._timer is None:
+            self._timer = self._loop.call_later(self.poll_interval, self.__tick)
+
+    def __tick(self):
+        self._timer = None
+        for conn in self._conns:
+            self.__poll(conn)
+
+        if any(len(p) > 0 for p in self._pending.values()):
+            self.__schedule()
+
+    def __poll(self, conn):
+        "Collect any results which have arrived on the connection"
+        pending = self._pending.get(id(conn), {})
+
+        for msgid, future in list(pending.items()):
+            try:
+                rtype, rdata, rmsgid, ctrls = conn.result3( msgid, all = 1, timeout = 0 )
+            except ldap.LDAPError as e:
+                del pending[msgid]
+                if not future.done():
+                    future.set_exception(e)
+                continue
+
+            if rtype is None:
+                # Not arrived yet
+                continue
+
+            del pending[msgid]
+            if not future.done():
+                future.set_result( (rtype, rdata, ctrls) )
+
+_directory = None
+
+async def get_directory():
+    "Get the shared Directory, opening it if needed"
+    global _directory
+
+    if _directory is None:
+        directory = Directory()
+        await directory.open()
+        _directory = directory
+
+    return _directory
+
+async def users_list():
+    "Async version of users.list()"
+    d = await get_directory()
+    res = await d.search( "ou=users,o=sr",
+                          ldap.SCOPE_ONELEVEL,
+                          "(objectClass=inetOrgPerson)",
+                          ["uid"] )
+    return _users._uids(res)
+
+async def groups_list(name_filter = None):
+    "Async version of groups.list()"
+    d = await get_directory()
+    res = await d.search( "ou=groups,o=sr",
+                          ldap.SCOPE_ONELEVEL,
+                          _groups._list_filter(name_filter),
+                          ["cn"] )
+    return ensure_text([x[1]["cn"][0] for x in res])
+
+async def user_search(**kwargs):
+    "Async version of users.user.search()"
+    filter_str = _users.user._search_filter(**kwargs)
+    if filter_str is None:
+        return None
+
+    d = await get_directory()
+    res = await d.search( "ou=users,o=sr",
+                          ldap.SCOPE_ONELEVEL,
+                          filter_str,
+                          ["uid"] )
+    return _users._uids(res)
+
+async def user_groups(u):
+    "Async version of users.user.groups()"
+    d = await get_directory()
+    res = await d.search( "ou=groups,o=sr",
+                          ldap.SCOPE_ONELEVEL,
+                          u._groups_filter(),
+                          ["cn"] )
+    return sorted(ensure_text([x[1]["cn"][0] for x in res]))
+
+async def _save(obj):
+    # Preparing a new user or group allocates its id, which searches the
+    # directory (and may write to it), so keep that off the event loop
+    is_new, modlist = await asyncio.get_event_loop().run_in_executor(None, obj._prepare_save)
+
+    if not is_new and len(modlist) == 0:
+        # Nothing has changed
+        obj._saved()
+        return True
+
+    d = await get_directory()
+    if is_new:
+        await d.add( obj.dn, modlist )
+    else:
+        await d.modify( obj.dn, modlist )
+
+    obj._saved()
+    return True
+
+async def user_save(u):
+    "Async version of users.user.save()"
+    result = await _save(u)
+    cache.invalidate_user(u.username)
+    roster.invalidate_user(u.username)
+    return result
+
+async def group_save(g):
+    "Async version of groups.group.save()"
+    changed = g.new_users + g.removed_users
+    result = await _save(g)
+    cache.invalidate_group(g.name)
+    roster.invalidate_group(g.name, changed)
+    membership.get_index().update_group(g.name, g.members)
+    return result
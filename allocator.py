@@ -0,0 +1,219 @@
+from __future__ import unicode_literals
+
+import bisect
+import ldap
+import threading
+import time
+
+from . import sr_ldap
+from .config import config
+from .sr_ldap import ensure_bytes, ensure_text, get_conn
+
+# Number of times to try taking a lease from the counter entry, when other
+# allocators keep taking them first
+LEASE_ATTEMPTS = 20
+
+class IdAllocator(object):
+    """Hands out numeric ids (uidNumbers or gidNumbers) which aren't in use.
+
+    The ids in use are kept as a sorted list of non-overlapping ranges, so
+    finding the next free id is a binary search rather than a scan. After
+    the first full scan of the directory only entries modified since the
+    previous refresh are fetched; a full rescan happens every
+    ``rescan_interval`` seconds to notice ids freed by deletions.
+
+    If there's a counter entry (see the [allocation] section of the config)
+    ids are leased a block at a time from it, so that allocators in other
+    processes and on other hosts never hand out the same ones."""
+
+    def __init__(self, first, attr, base, filterstr, nss_ids = None, rescan_interval = 3600,
+                 counter_dn = None):
+        """Args: first = the lowest id to hand out
+                 attr = the attribute holding the id
+                 base, filterstr = where to search for entries using ids
+                 nss_ids = optional function returning the ids known to NSS
+                 counter_dn = the counter entry, "" for none, or None to
+                              use the one in the config"""
+        self.first = first
+        self.attr = attr
+        self.base = base
+        self.filterstr = filterstr
+        self.nss_ids = nss_ids
+        self.rescan_interval = rescan_interval
+        self.counter_dn = counter_dn
+
+        # Sorted starts and (inclusive) ends of the ranges of used ids
+        self._starts = []
+        self._ends = []
+        # Ids which have been handed out, but might not be in the directory yet
+        self._reserved = set()
+        # Ids leased from the counter entry which haven't been handed out
+        self._leased = []
+
+        self._last_scan = None
+        self._timestamp = None
+        self._lock = threading.RLock()
+
+    def allocate(self):
+        "Get a single free id, and mark it as used"
+        return self.allocate_block(1)[0]
+
+    def allocate_block(self, count):
+        "Get a list of ``count`` free ids, and mark them as used"
+        with self._lock:
+            self.refresh()
+
+            counter_dn = self.counter_dn
+            if counter_dn is None:
+                counter_dn = config.get('allocation', 'counter_dn')
+
+            ids = []
+            candidate = self.first
+            while len(ids) < count:
+                if counter_dn:
+                    if len(self._leased) == 0:
+                        self._leased = self.__lease( counter_dn,
+                                                     max(config.getint('allocation', 'lease_size'),
+                                                         count - len(ids)) )
+                    candidate = self._leased.pop(0)
+                    if self.is_used(candidate):
+                        continue
+                else:
+                    candidate = self.__next_free(candidate)
+
+                ids.append(candidate)
+                candidate += 1
+
+            for i in ids:
+                self.mark_used(i)
+            self._reserved.update(ids)
+
+            return ids
+
+    def is_used(self, i):
+        with self._lock:
+            idx = bisect.bisect_right(self._starts, i) - 1
+            return idx >= 0 and self._ends[idx] >= i
+
+    def mark_used(self, i):
+        "Record that the given id is in use"
+        with self._lock:
+            idx = bisect.bisect_right(self._starts, i) - 1
+
+            if idx >= 0 and self._ends[idx] >= i:
+                # Already in a range
+                return
+
+            joins_prev = idx >= 0 and self._ends[idx] == i - 1
+            joins_next = idx + 1 < len(self._starts) and self._starts[idx + 1] == i + 1
+
+            if joins_prev and joins_next:
+                self._ends[idx] = self._ends[idx + 1]
+                del self._starts[idx + 1]
+                del self._ends[idx + 1]
+            elif joins_prev:
+                self._ends[idx] = i
+            elif joins_next:
+                self._starts[idx + 1] = i
+            else:
+                self._starts.insert(idx + 1, i)
+                self._ends.insert(idx + 1, i)
+
+    def refresh(self, full = False):
+        """Update the ids in use from the directory. Only fetches the entries
+        changed since the last refresh, unless a full rescan is due."""
+        with self._lock:
+            if full or self._last_scan is None \
+                    or time.time() - self._last_scan > self.rescan_interval:
+                self.__scan()
+            else:
+                self.__update()
+
+    def __next_free(self, i):
+        "Find the lowest free id that's at least i"
+        idx = bisect.bisect_right(self._starts, i) - 1
+        if idx >= 0 and self._ends[idx] >= i:
+            # Ranges are merged, so the one after this must start later
+            return self._ends[idx] + 1
+        return i
+
+    def __lease(self, counter_dn, count):
+        """Take the next ``count`` ids from the counter entry. The counter is
+        moved on by a modify which removes the value that was read, so fails
+        (and is tried again) if another allocator moved it on in between."""
+        for attempt in range(LEASE_ATTEMPTS):
+            with sr_ldap.consistent():
+                res = get_conn().search_st( counter_dn,
+                                            ldap.SCOPE_BASE,
+                                            attrlist = [self.attr] )
+            values = res[0][1].get(self.attr) if len(res) > 0 else None
+
+            if values:
+                start = max(int(values[0]), self.first)
+                modlist = [ (ldap.MOD_DELETE, self.attr, [values[0]]),
+                            (ldap.MOD_ADD, self.attr, [ensure_bytes(str(start + count))]) ]
+            else:
+                # A new counter starts after the ids already in use
+                start = self.first if len(self._ends) == 0 else max(self.first, self._ends[-1] + 1)
+                modlist = [ (ldap.MOD_ADD, self.attr, [ensure_bytes(str(start + count))]) ]
+
+            try:
+                get_conn().modify_s( counter_dn, modlist )
+            except (ldap.NO_SUCH_ATTRIBUTE, ldap.TYPE_OR_VALUE_EXISTS):
+                # Another allocator took a lease first
+                continue
+
+            return [i for i in range(start, start + count)]
+
+        raise Exception( "Couldn't lease %ss from '%s': too many other allocators" % (self.attr, counter_dn) )
+
+    def __search(self, filterstr):
+        sr_ldap.bind()
+        res = get_conn().search_st( self.base,
+                                    ldap.SCOPE_ONELEVEL,
+                                    filterstr = filterstr,
+                                    attrlist = [self.attr, "modifyTimestamp"] )
+
+        ids = []
+        for dn, attrs in res:
+            if self.attr in attrs:
+                ids.append(int(attrs[self.attr][0]))
+
+            if "modifyTimestamp" in attrs:
+                timestamp = ensure_text(attrs["modifyTimestamp"][0])
+                if self._timestamp is None or timestamp > self._timestamp:
+                    self._timestamp = timestamp
+
+        return ids
+
+    def __scan(self):
+        "Rebuild the ranges from every entry in the directory"
+        start = time.time()
+        ids = set(self.__search(self.filterstr))
+
+        # Reservations which have been saved don't need remembering any more
+        self._reserved -= ids
+        ids |= self._reserved
+
+        if self.nss_ids is not None:
+            ids.update(self.nss_ids())
+
+        self._starts = []
+        self._ends = []
+        for i in sorted(ids):
+            if len(self._ends) > 0 and self._ends[-1] == i - 1:
+                self._ends[-1] = i
+            else:
+                self._starts.append(i)
+                self._ends.append(i)
+
+        self._last_scan = start
+
+    def __update(self):
+        "Add the ids of the entries changed since the last refresh"
+        if self._timestamp is None:
+            return self.__scan()
+
+        filterstr = "(&{0}(modifyTimestamp>={1}))".format(self.filterstr, self._timestamp)
+        for i in self.__search(filterstr):
+            self.mark_used(i)
@@ -0,0 +1,219 @@
+"""
+Benchmarks of the common srusers operations against a generated directory.
+
+The directory is held in memory (see memory.MemoryBackend) and seeded with
+the given numbers of users, colleges and teams. Each operation is timed
+and the number of round trips it makes to the directory counted, and the
+results written out as JSON so they can be compared between releases.
+The time taken to import the package is measured too, and the run fails
+if it's over budget or importing reads the config:
+
+    python -m srusers.bench --users 10000 100000 --output results.json
+"""
+
+from __future__ import print_function, unicode_literals
+
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import time
+
+from . import groups
+from . import metrics
+from . import sr_ldap
+from . import users
+from .constants import COLLEGE_PREFIX, TEAM_PREFIX
+from .memory import MemoryBackend
+from .sr_ldap import ensure_bytes
+
+timer = getattr(time, "perf_counter", time.time)
+
+def seed(backend, n_users, n_colleges, n_teams):
+    """Fill a backend with users spread evenly across colleges and teams.
+    Returns the names of the college and team groups."""
+    colleges = ["%sc%03d" % (COLLEGE_PREFIX, i) for i in range(n_colleges)]
+    teams = ["%sT%03d" % (TEAM_PREFIX, i) for i in range(n_teams)]
+
+    college_members = dict([(c, []) for c in colleges])
+    team_members = dict([(t, []) for t in teams])
+
+    for i in range(n_users):
+        college = colleges[i % n_colleges]
+        tla = college[len(COLLEGE_PREFIX):]
+        username = "%s_%s%i" % (tla, "ab", i)
+
+        backend.add_s( "uid=%s,ou=users,o=sr" % username,
+                       [ ("objectClass", [b"inetOrgPerson", b"uidObject", b"posixAccount"]),
+                         ("uid", ensure_bytes(username)),
+                         ("cn", ensure_bytes("User %i" % i)),
+                         ("sn", b"User"),
+                         ("mail", ensure_bytes("%s@example.com" % username)),
+                         ("uidNumber", ensure_bytes(str(2000 + i))),
+                         ("gidNumber", b"1999"),
+                         ("homeDirectory", ensure_bytes("/home/%s" % username)),
+                         ("loginShell", b"/bin/bash") ] )
+
+        college_members[college].append(username)
+        team_members[teams[i % n_teams]].append(username)
+
+    gid = 3000
+    for members in (college_members, team_members):
+        for name, usernames in members.items():
+            backend.add_s( "cn=%s,ou=groups,o=sr" % name,
+                           [ ("objectClass", b"posixGroup"),
+                             ("cn", ensure_bytes(name)),
+                             ("gidNumber", ensure_bytes(str(gid))),
+                             ("description", ensure_bytes("%s group" % name)),
+                             ("memberUid", ensure_bytes(usernames)) ] )
+            gid += 1
+
+    return colleges, teams
+
+def measure(fn, repeat):
+    "Run fn repeatedly, returning its timings and round trips per run"
+    times = []
+    trips = []
+    for i in range(repeat):
+        with metrics.request() as r:
+            start = timer()
+            fn(i)
+            times.append(timer() - start)
+        trips.append(r.round_trips)
+
+    times.sort()
+    return { "seconds": { "min": times[0],
+                          "median": times[len(times) // 2],
+                          "max": times[-1] },
+             "round_trips": max(trips) }
+
+def operations(colleges, teams, n_users):
+    "The operations to benchmark, as a list of (name, fn) pairs"
+    big_group = colleges[0]
+    # Users which aren't in the big group, to add to it
+    outsiders = ["%s_ab%i" % (colleges[i % len(colleges)][len(COLLEGE_PREFIX):], i)
+                 for i in range(n_users) if i % len(colleges) != 0]
+
+    def new_username(i):
+        users.new_username(colleges[0], "A", "B")
+
+    def list_users(i):
+        users.list()
+
+    def search(i):
+        users.user.search(email = "%s_ab0@example.com" % colleges[0][len(COLLEGE_PREFIX):])
+
+    def load_user(i):
+        users.user("%s_ab%i" % (colleges[0][len(COLLEGE_PREFIX):], 0))
+
+    def group_user_add(i):
+        g = groups.group(big_group)
+        g.user_add(outsiders[i * 100:(i + 1) * 100])
+        g.save()
+
+    def list_groups(i):
+        groups.list()
+
+    def allocate_uid(i):
+        users._uid_allocator.refresh(full = True)
+        users._uid_allocator.allocate()
+
+    def allocate_gid(i):
+        groups._gid_allocator.refresh(full = True)
+        groups._gid_allocator.allocate()
+
+    return [ ("new_username", new_username),
+             ("users.list", list_users),
+             ("user.search", search),
+             ("users.user", load_user),
+             ("group.user_add", group_user_add),
+             ("groups.list", list_groups),
+             ("uid_allocation", allocate_uid),
+             ("gid_allocation", allocate_gid) ]
+
+def run(n_users, n_colleges, n_teams, repeat):
+    "Seed a fresh directory and benchmark each operation against it"
+    backend = MemoryBackend( rootpw = "bench" )
+    colleges, teams = seed(backend, n_users, n_colleges, n_teams)
+
+    sr_ldap.set_userinfo(lambda: ("cn=Manager,o=sr", "bench"))
+    sr_ldap.set_backend(backend)
+    sr_ldap.bind()
+
+    results = []
+    for name, fn in operations(colleges, teams, n_users):
+        result = measure(fn, repeat)
+        result.update({ "operation": name,
+                        "users": n_users,
+                        "colleges": n_colleges,
+                        "teams": n_teams })
+        results.append(result)
+
+    return results
+
+# Script timing how long importing the package takes, in a fresh interpreter
+IMPORT_SCRIPT = """
+import time
+timer = getattr(time, "perf_counter", time.time)
+start = timer()
+import {0}
+print(timer() - start)
+print({0}.config._parser is None)
+"""
+
+def import_time(repeat):
+    """Time importing the package in a fresh interpreter, returning the
+    fastest time and whether importing it was free of reading the config"""
+    times = []
+    lazy = True
+    for i in range(repeat):
+        output = subprocess.check_output( [ sys.executable, "-c",
+                                            IMPORT_SCRIPT.format(__package__) ] )
+        seconds, config_unread = output.decode("utf-8").split()
+        times.append(float(seconds))
+        lazy = lazy and config_unread == "True"
+
+    return { "operation": "import",
+             "seconds": { "min": min(times),
+                          "median": sorted(times)[len(times) // 2],
+                          "max": max(times) },
+             "config_read": not lazy }
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = __doc__.strip().split("\n")[0])
+    parser.add_argument("--users", type = int, nargs = "+", default = [10000, 100000],
+                        help = "Directory sizes to benchmark at")
+    parser.add_argument("--colleges", type = int, default = 100)
+    parser.add_argument("--teams", type = int, default = 300)
+    parser.add_argument("--repeat", type = int, default = 5,
+                        help = "Number of times to run each operation")
+    parser.add_argument("--output", help = "File to write the results to (default: stdout)")
+    parser.add_argument("--import-budget", type = float, default = 0.15,
+                        help = "Fail if importing srusers takes longer than this many seconds")
+    args = parser.parse_args(argv)
+
+    imported = import_time(args.repeat)
+    results = [imported]
+    for n_users in args.users:
+        results.extend(run(n_users, args.colleges, args.teams, args.repeat))
+
+    report = { "python": platform.python_version(),
+               "platform": platform.platform(),
+               "results": results }
+
+    if args.output is None:
+        json.dump(report, sys.stdout, indent = 2, sort_keys = True)
+        print()
+    else:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent = 2, sort_keys = True)
+
+    if imported["seconds"]["min"] > args.import_budget or imported["config_read"]:
+        sys.stderr.write("Importing srusers took %.3fs (budget %.3fs)%s\n"
+                         % ( imported["seconds"]["min"], args.import_budget,
+                             ", and read the config" if imported["config_read"] else "" ))
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
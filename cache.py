@@ -0,0 +1,105 @@
+from __future__ import unicode_literals
+
+import collections
+import threading
+import time
+
+from .config import config
+
+class DirectoryCache(object):
+    """A cache of search results, holding at most ``size`` entries, each for
+    at most ``ttl`` seconds. The least recently used entries are dropped
+    first when it's full. A size of 0 disables the cache."""
+
+    def __init__(self, size = 1000, ttl = 60):
+        self.size = size
+        self.ttl = ttl
+
+        # key -> (time stored, value), least recently used first
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self):
+        return self.size > 0
+
+    def get(self, key):
+        "Returns a tuple of whether the key was found, and its value"
+        if not self.enabled:
+            return (False, None)
+
+        with self._lock:
+            item = self._entries.pop(key, None)
+
+            if item is None or time.time() - item[0] > self.ttl:
+                self.misses += 1
+                return (False, None)
+
+            # Re-insert to mark as most recently used
+            self._entries[key] = item
+            self.hits += 1
+            return (True, item[1])
+
+    def put(self, key, value):
+        if not self.enabled:
+            return
+
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time(), value)
+
+            while len(self._entries) > self.size:
+                self._entries.popitem(last = False)
+                self.evictions += 1
+
+    def invalidate(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return { "size": len(self._entries),
+                     "hits": self.hits,
+                     "misses": self.misses,
+                     "evictions": self.evictions }
+
+def user_keys(username):
+    "The keys under which a user's entry may be cached"
+    return [ ("user", username.lower(), False),
+             ("user", username, True) ]
+
+def user_key(username, match_case):
+    if not match_case:
+        username = username.lower()
+    return ("user", username, match_case)
+
+def group_key(name):
+    # Group names are matched case insensitively
+    return ("group", name.lower())
+
+_cache = None
+
+def get_cache():
+    "Get the shared cache, configured from the [cache] section of the config"
+    global _cache
+
+    if _cache is None:
+        _cache = DirectoryCache( config.getint('cache', 'size'),
+                                 config.getint('cache', 'ttl') )
+
+    return _cache
+
+def invalidate_user(username):
+    get_cache().invalidate(*user_keys(username))
+
+def invalidate_group(name):
+    get_cache().invalidate(group_key(name))
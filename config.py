@@ -1,4 +1,3 @@
-
 try:
     from ConfigParser import SafeConfigParser
 except ImportError:
@@ -6,16 +5,29 @@ except ImportError:
 
 import os.path
 
-config = None
+_parser = None
 
 def _read_config():
-    global config
-    config = SafeConfigParser()
+    global _parser
+    parser = SafeConfigParser()
 
     baseDir = os.path.dirname(__file__)
 
-    config.readfp(open(os.path.join(baseDir, 'config.ini')))
-    config.read([os.path.join(baseDir, 'local.ini')])
+    parser.readfp(open(os.path.join(baseDir, 'config.ini')))
+    parser.read([os.path.join(baseDir, 'local.ini')])
+    _parser = parser
+
+def get_config():
+    "Get the config parser, reading the config files the first time"
+    if _parser is None:
+        _read_config()
+    return _parser
+
+class _LazyConfig(object):
+    """Stands in for the config parser, so that the config files are only
+    read when an option is first looked up rather than on import"""
+
+    def __getattr__(self, name):
+        return getattr(get_config(), name)
 
-if config is None:
-    _read_config()
+config = _LazyConfig()
@@ -3,24 +3,65 @@ from __future__ import unicode_literals
 import grp
 import ldap
 
+from . import allocator
+from . import cache
+from . import membership
+from . import mirror
+from . import roster
 from . import sr_ldap
 from .sr_ldap import ensure_bytes, ensure_text, get_conn
 
 # Get a list of all groups
 def list(name_filter = None):
+    m = mirror.active()
+    if m is not None:
+        return m.group_names(name_filter)
+
+    return [name for name in iter_list(name_filter)]
+
+def iter_list(name_filter = None, page_size = None):
+    """Generator of the names of all the groups (optionally matching the
+    given name), fetched a page at a time"""
+    sr_ldap.bind()
+
+    for dn, attrs in sr_ldap.paged_search( "ou=groups,o=sr",
+                                           ldap.SCOPE_ONELEVEL,
+                                           _list_filter(name_filter),
+                                           attrlist = ["cn"],
+                                           page_size = page_size ):
+        yield ensure_text(attrs["cn"][0])
+
+def iter_groups(name_filter = None, page_size = None):
+    """Generator of group objects for all the groups (optionally matching
+    the given name), fetched a page at a time"""
     sr_ldap.bind()
 
+    for dn, attrs in sr_ldap.paged_search( "ou=groups,o=sr",
+                                           ldap.SCOPE_ONELEVEL,
+                                           _list_filter(name_filter),
+                                           page_size = page_size ):
+        yield group._from_entry(dn, attrs)
+
+def _list_filter(name_filter):
+    "The filter used to list groups, optionally matching the given name"
     filterstr = "(objectClass=posixGroup)"
     if name_filter != None:
         filterstr = "(&%s(cn=%s))" % (filterstr, name_filter)
+    return filterstr
 
-    g_res = get_conn().search_st( "ou=groups,o=sr",
-                                  ldap.SCOPE_ONELEVEL,
-                                  filterstr=filterstr )
+def memberships(usernames):
+    """Returns a dict of each of the given usernames to a list of the groups
+    that user is in, answered from an index of all the groups"""
+    return membership.get_index().memberships(usernames)
 
-    groups = ensure_text([x[1]["cn"][0] for x in g_res])
+def _nss_gids():
+    "The gids of all the groups known to NSS, including local ones"
+    return [g.gr_gid for g in grp.getgrall()]
 
-    return groups
+_gid_allocator = allocator.IdAllocator( 3000, "gidNumber",
+                                        "ou=groups,o=sr",
+                                        "(objectClass=posixGroup)",
+                                        nss_ids = _nss_gids )
 
 def uname_from_dn(dn):
     "Extract a username from a dn"
@@ -32,7 +73,7 @@ def uname_to_dn(uname):
     "Return the user's dn"
     return "uid=%s,ou=users,o=sr" % uname
 
-class group:
+class group(object):
     """A group of users"""
 
     def __init__( self, name ):
@@ -40,6 +81,30 @@ class group:
         Args: name = the name of the group"""
         sr_ldap.bind()
 
+        self.__init_common(name)
+
+        if not self.__load(self.name):
+            #Have to create new
+            # The gid is only allocated when the group is first saved
+            self.gid = None
+            self.in_db = False
+            self.members = []
+            self.dn = "cn=%s,ou=groups,o=sr" % (self.name)
+            self.desc = "%s group" % self.name
+            self.__saved_state = None
+        else:
+            self.in_db = True
+
+    @classmethod
+    def _from_entry(cls, dn, attrs):
+        "Create a group from an entry returned by a search, without searching again"
+        g = cls.__new__(cls)
+        g.__init_common(ensure_text(attrs["cn"][0]))
+        g.__set_entry(dn, attrs)
+        g.in_db = True
+        return g
+
+    def __init_common(self, name):
         self.name = ensure_text(name)
 
         #List of new users
@@ -54,38 +119,39 @@ class group:
         if self.name == "shell-users":
             self.full_user_dn = True
 
-        if not self.__load(self.name):
-            #Have to create new
-            self.gid = self.__get_new_gidNumber()
-            self.in_db = False
-            self.members = []
-            self.dn = "cn=%s,ou=groups,o=sr" % (self.name)
-            self.desc = "%s group" % self.name
-        else:
-            self.in_db = True
-
     def __load(self, name):
-        info = get_conn().search_st( "ou=groups,o=sr",
-                                 ldap.SCOPE_ONELEVEL,
-                                 filterstr="(&(objectClass=posixGroup)(cn=%s))" % ( name ) )
+        found, info = cache.get_cache().get(cache.group_key(name))
 
-        if len(info) == 1:
-            self.dn = info[0][0]
-            self.gid = int( info[0][1]["gidNumber"][0] )
+        if not found:
+            info = get_conn().search_st( "ou=groups,o=sr",
+                                     ldap.SCOPE_ONELEVEL,
+                                     filterstr="(&(objectClass=posixGroup)(cn=%s))" % ( name ) )
+            cache.get_cache().put(cache.group_key(name), info)
 
-            if "description" in info[0][1]:
-                self.desc = ensure_text(info[0][1]["description"][0])
-            else:
-                self.desc = None
-
-            if "memberUid" in info[0][1].keys():
-                self.members = ensure_text(self.__unames_from_dn( info[0][1]["memberUid"] ))
-            else:
-                self.members = []
+        if len(info) == 1:
+            self.__set_entry(*info[0])
             return True
         else:
             return False
 
+    def __set_entry(self, dn, attrs):
+        self.dn = dn
+        self.gid = int( attrs["gidNumber"][0] )
+
+        if "description" in attrs:
+            self.desc = ensure_text(attrs["description"][0])
+        else:
+            self.desc = None
+
+        if "memberUid" in attrs.keys():
+            stored = ensure_text(attrs["memberUid"])
+            self.members = self.__unames_from_dn( stored )
+        else:
+            stored = []
+            self.members = []
+
+        self.__saved_state = (self.gid, self.desc, dict(zip(self.members, stored)))
+
     def user_add(self, userl, require_case_match = False):
         """Add a user to the group"""
         # Delayed import to avoid circular imports not resolving
@@ -98,35 +164,44 @@ class group:
             userl = [userl]
 
         failed = []
+        usernames = []
         for user in userl:
-            # Check the user's real
-
             if isinstance(user, users.user):
-                u = user
+                if not user.in_db:
+                    failed.append(user)
+                else:
+                    self.__add_member(user.username)
             else:
-                u = users.user(user, require_case_match)
+                usernames.append(user)
 
-            if not u.in_db:
-                failed.append(user)
-                continue
+        # Check the users are real, all at once
+        found, missing = users.user.load_many(usernames, require_case_match, attrs = ["username"])
+        failed.extend(missing)
 
-            if u.username not in self.members:
-                self.members.append( u.username )
-                self.new_users.append( u.username )
+        for u in found:
+            self.__add_member(u.username)
 
         return failed
 
+    def __add_member(self, username):
+        if username not in self.members:
+            self.members.append( username )
+            self.new_users.append( username )
+
     def user_rm(self,userl):
         """Remove a user from a group"""
         # Delayed import to avoid circular imports not resolving
         from . import users
 
-        if userl.__class__ is users.user:
+        if isinstance(userl, users.user):
             userl = [userl.username]
         # Can't just use "list" as we've got our own function of that name above
         elif type(userl) is not type([]):
             userl = [userl]
 
+        # Accept user objects in the list, as well as usernames
+        userl = [u.username if isinstance(u, users.user) else u for u in userl]
+
         not_members = []
         for user in set(userl):
             if user in self.members:
@@ -141,19 +216,75 @@ class group:
         """Delete the group"""
         if not self.in_db:
             raise Exception("Cannot delete group '%s' - doesn't exist in database" % (self.name))
-        else:
-            get_conn().delete_s( self.dn )
-            self.in_db = False
+
+        batch = sr_ldap.current_batch()
+        if batch is not None:
+            batch.delete( self.dn, self.__deleted )
             return True
 
+        get_conn().delete_s( self.dn )
+        self.__deleted()
+        return True
+
+    def __deleted(self):
+        cache.invalidate_group(self.name)
+        roster.invalidate_group(self.name, self.members)
+        membership.get_index().remove_group(self.name)
+        self.in_db = False
+
     def save(self):
         """Save the group"""
+        is_new, modlist = self._prepare_save()
+
+        if not is_new and len(modlist) == 0:
+            # Nothing has changed
+            self._saved()
+            return True
+
+        batch = sr_ldap.current_batch()
+        if batch is not None:
+            # Written when the batch ends
+            if is_new:
+                batch.add( self.dn, modlist, self.__written )
+            else:
+                batch.modify( self.dn, modlist, self.__written )
+            return True
+
+        if is_new:
+            get_conn().add_s( self.dn, modlist )
+        else:
+            get_conn().modify_s( self.dn, modlist )
+
+        self.__written()
+        return True
+
+    def __written(self):
+        cache.invalidate_group(self.name)
+        roster.invalidate_group(self.name, self.new_users + self.removed_users)
+        membership.get_index().update_group(self.name, self.members)
+        self._saved()
+
+    def _prepare_save(self):
+        """Build the modlist to save the group.
+        Returns a tuple of whether the group is new, and the modlist."""
+        if not self.in_db and self.gid is None:
+            self.gid = self.__get_new_gidNumber()
+
         if self.in_db:
-            return self.__update()
+            return (False, self.__update_modlist())
         else:
-            return self.__save_new()
+            return (True, self.__new_modlist())
+
+    def _saved(self):
+        "Record that the changes to the group have been written to the database"
+        self.in_db = True
+        self.new_users = []
+        self.removed_users = []
+
+        stored = self.__unames_to_dn( self.members )
+        self.__saved_state = (self.gid, self.desc, dict(zip(self.members, stored)))
 
-    def __save_new(self):
+    def __new_modlist(self):
         modlist = [ ("objectClass", b"posixGroup"),
                     ("cn", ensure_bytes(self.name)),
                     ("gidNumber", ensure_bytes(str(self.gid))),
@@ -162,55 +293,44 @@ class group:
         if len(self.members) > 0:
             modlist.append( ("memberUid", ensure_bytes(self.__unames_to_dn( self.members ))) )
 
-        get_conn().add_s( self.dn, modlist )
+        return modlist
 
-        self.in_db = True
-        self.new_users = []
-        self.removed_users = []
-        return True
+    def __update_modlist(self):
+        """The modlist to change the group from how it was last loaded or saved.
+        Only membership changes are sent, rather than the whole member list."""
+        saved_gid, saved_desc, saved_members = self.__saved_state
+        members = set(self.members)
 
-    def __update(self):
-        modlist = [ ( ldap.MOD_REPLACE,
-                      "memberUid",
-                      ensure_bytes(self.__unames_to_dn( self.members )) ),
-                    ( ldap.MOD_REPLACE,
-                      "description",
-                      ensure_bytes(self.desc) ),
-                    ( ldap.MOD_REPLACE,
-                      "gidNumber",
-                      ensure_bytes(str(self.gid)) ) ]
+        added = [m for m in self.members if m not in saved_members]
+        # Remove the values exactly as they're stored
+        removed = [v for m, v in saved_members.items() if m not in members]
 
-        get_conn().modify_s( self.dn, modlist )
+        modlist = []
+        if len(added) > 0:
+            modlist.append( ( ldap.MOD_ADD,
+                              "memberUid",
+                              ensure_bytes(self.__unames_to_dn( added )) ) )
 
-        self.new_users = []
-        self.removed_users = []
+        if len(removed) > 0:
+            modlist.append( ( ldap.MOD_DELETE,
+                              "memberUid",
+                              ensure_bytes(removed) ) )
+
+        if self.desc != saved_desc:
+            modlist.append( ( ldap.MOD_REPLACE,
+                              "description",
+                              ensure_bytes(self.desc) ) )
+
+        if self.gid != saved_gid:
+            modlist.append( ( ldap.MOD_REPLACE,
+                              "gidNumber",
+                              ensure_bytes(str(self.gid)) ) )
+
+        return modlist
 
     def __get_new_gidNumber( self ):
         """Finds the next available GID"""
-        groups = get_conn().search_st( "ou=groups,o=sr",
-                                   ldap.SCOPE_ONELEVEL,
-                                   filterstr = "(objectClass=posixGroup)",
-                                   attrlist = ["gidNumber"] )
-        gids = []
-
-        for gid in [int(x[1]["gidNumber"][0]) for x in groups]:
-            gids.append(gid)
-
-        gid = 2999
-        while True:
-            gid += 1
-
-            if gid in gids:
-                "An ldap group with that gid already exists"
-                continue
-
-            try:
-                grp.getgrgid(gid)
-            except KeyError:
-                "The group isn't in the local stuff either"
-                break
-
-        return gid
+        return _gid_allocator.allocate()
 
     def __str__(self):
         desc = ""
@@ -0,0 +1,137 @@
+from __future__ import unicode_literals
+
+import ldap
+import threading
+import time
+
+from . import sr_ldap
+from .config import config
+from .sr_ldap import ensure_text, get_conn
+
+def _member_uname(value):
+    "Get the username from a memberUid value, which may be a full user dn"
+    if value.startswith("uid=") and "," in value:
+        return value.split(",")[0][len("uid="):]
+    return value
+
+class MembershipIndex(object):
+    """An index of which groups each user is in.
+
+    It's built from a single pass over all the groups, after which only
+    the groups modified since the previous refresh are fetched (at most once
+    every ``refresh_interval`` seconds). A full rescan happens every
+    ``rescan_interval`` seconds to notice groups deleted elsewhere."""
+
+    def __init__(self, refresh_interval = 5, rescan_interval = 600):
+        self.refresh_interval = refresh_interval
+        self.rescan_interval = rescan_interval
+
+        # group name -> set of usernames, and username -> set of group names
+        self._members = {}
+        self._groups = {}
+
+        self._last_scan = None
+        self._last_refresh = None
+        self._timestamp = None
+        self._lock = threading.RLock()
+
+    def memberships(self, usernames):
+        "Returns a dict of each of the usernames to a sorted list of its groups"
+        with self._lock:
+            self.refresh()
+
+            result = {}
+            for username in usernames:
+                result[username] = sorted(self._groups.get(username, ()))
+            return result
+
+    def members_of(self, name):
+        "Returns a sorted list of the members of a group, or None if there's no such group"
+        with self._lock:
+            self.refresh()
+
+            members = self._members.get(name)
+            return None if members is None else sorted(members)
+
+    def groups_of(self, username):
+        "Returns a sorted list of the groups the user is in"
+        return self.memberships([username])[username]
+
+    def update_group(self, name, members):
+        "Record the members of a group, after it's been changed"
+        with self._lock:
+            self.remove_group(name)
+
+            members = set(members)
+            self._members[name] = members
+            for username in members:
+                self._groups.setdefault(username, set()).add(name)
+
+    def remove_group(self, name):
+        with self._lock:
+            for username in self._members.pop(name, ()):
+                groups = self._groups.get(username)
+                groups.discard(name)
+                if len(groups) == 0:
+                    del self._groups[username]
+
+    def refresh(self, full = False):
+        """Bring the index up to date, with a full rescan if one is due or
+        ``full`` is set, otherwise only fetching recently changed groups"""
+        with self._lock:
+            now = time.time()
+
+            if full or self._last_scan is None or self._timestamp is None \
+                    or now - self._last_scan > self.rescan_interval:
+                self.__scan()
+            elif now - self._last_refresh >= self.refresh_interval:
+                self.__update()
+
+    def __add_results(self, results):
+        for dn, attrs in results:
+            name = ensure_text(attrs["cn"][0])
+            members = [_member_uname(m) for m in ensure_text(attrs.get("memberUid", []))]
+            self.update_group(name, members)
+
+            if "modifyTimestamp" in attrs:
+                timestamp = ensure_text(attrs["modifyTimestamp"][0])
+                if self._timestamp is None or timestamp > self._timestamp:
+                    self._timestamp = timestamp
+
+    def __scan(self):
+        start = time.time()
+        sr_ldap.bind()
+
+        self._members = {}
+        self._groups = {}
+        self.__add_results( sr_ldap.paged_search( "ou=groups,o=sr",
+                                                  ldap.SCOPE_ONELEVEL,
+                                                  "(objectClass=posixGroup)",
+                                                  attrlist = ["cn", "memberUid", "modifyTimestamp"] ) )
+
+        self._last_scan = start
+        self._last_refresh = start
+
+    def __update(self):
+        start = time.time()
+        sr_ldap.bind()
+
+        filterstr = "(&(objectClass=posixGroup)(modifyTimestamp>={0}))".format(self._timestamp)
+        self.__add_results( get_conn().search_st( "ou=groups,o=sr",
+                                                  ldap.SCOPE_ONELEVEL,
+                                                  filterstr = filterstr,
+                                                  attrlist = ["cn", "memberUid", "modifyTimestamp"] ) )
+
+        self._last_refresh = start
+
+_index = None
+
+def get_index():
+    "Get the shared index, configured from the [memberships] section of the config"
+    global _index
+
+    if _index is None:
+        _index = MembershipIndex( config.getint('memberships', 'refresh_interval'),
+                                  config.getint('memberships', 'rescan_interval') )
+
+    return _index
@@ -0,0 +1,510 @@
+"""
+A directory held entirely in memory, which can be used in place of the
+LDAP server (see sr_ldap.set_backend, or the "backend" config option).
+
+It supports the operations and search filters that srusers uses, with
+hash indexes on the attributes entries are looked up by, so it's suited
+to testing, staging and load tests rather than being a general purpose
+LDAP server.
+"""
+
+from __future__ import unicode_literals
+
+import base64
+import contextlib
+import hashlib
+import itertools
+import ldap
+import re
+import threading
+import time
+
+from .sr_ldap import ensure_bytes, ensure_text
+
+# Attributes which are compared case sensitively; all others aren't
+CASE_EXACT = set(["memberUid", "homeDirectory", "userPassword"])
+
+# Attributes which are compared as integers
+INTEGERS = set(["uidNumber", "gidNumber"])
+
+# Attributes with hash indexes
+INDEXED = ("uid", "cn", "memberUid", "uidNumber", "gidNumber", "objectClass")
+
+# Operational attributes, which are only returned when asked for by name
+OPERATIONAL = ("createTimestamp", "modifyTimestamp")
+
+def _norm_dn(dn):
+    return ",".join([part.strip() for part in ensure_text(dn).split(",")]).lower()
+
+def _parent(norm_dn):
+    return norm_dn.split(",", 1)[-1]
+
+def _norm_value(attr, value, case_exact = None):
+    "The form of a value used for comparisons and the indexes"
+    value = ensure_text(value)
+    if attr in INTEGERS:
+        try:
+            return int(value)
+        except ValueError:
+            return value
+    if case_exact is None:
+        case_exact = attr in CASE_EXACT
+    return value if case_exact else value.lower()
+
+def _unescape(value):
+    "Undo RFC 4515 escaping of a filter value"
+    return re.sub(r"\\([0-9a-fA-F]{2})", lambda m: chr(int(m.group(1), 16)), value)
+
+def parse_filter(filterstr):
+    """Parse an RFC 4515 search filter into a tree of tuples:
+    ("&", [children]), ("|", [children]), ("!", child), or
+    (op, attr, case_exact, value) where op is one of "=", "present",
+    "substring", ">=" and "<=", and for substrings value is the list of
+    (unescaped) parts between the *s."""
+    node, pos = _parse(filterstr.strip(), 0)
+    if pos != len(filterstr.strip()):
+        raise ldap.FILTER_ERROR({'desc': "Bad search filter", 'info': filterstr})
+    return node
+
+_item_re = re.compile(r"^([\w.-]+)(?::dn)?(?::([\w.-]+))?:?(>=|<=|~=|=)(.*)$", re.DOTALL)
+
+def _parse(f, pos):
+    if pos >= len(f) or f[pos] != "(":
+        raise ldap.FILTER_ERROR({'desc': "Bad search filter", 'info': f})
+    pos += 1
+
+    if f[pos] in "&|!":
+        op = f[pos]
+        pos += 1
+        children = []
+        while pos < len(f) and f[pos] == "(":
+            child, pos = _parse(f, pos)
+            children.append(child)
+        if pos >= len(f) or f[pos] != ")":
+            raise ldap.FILTER_ERROR({'desc': "Bad search filter", 'info': f})
+        if op == "!":
+            if len(children) != 1:
+                raise ldap.FILTER_ERROR({'desc': "Bad search filter", 'info': f})
+            return ("!", children[0]), pos + 1
+        return (op, children), pos + 1
+
+    end = f.find(")", pos)
+    if end == -1:
+        raise ldap.FILTER_ERROR({'desc': "Bad search filter", 'info': f})
+
+    m = _item_re.match(f[pos:end])
+    if m is None:
+        raise ldap.FILTER_ERROR({'desc': "Bad search filter", 'info': f})
+
+    attr, rule, op, value = m.groups()
+    case_exact = None
+    if rule is not None:
+        case_exact = rule.lower().startswith("caseexact")
+
+    if op == "~=":
+        op = "="
+
+    if op == "=" and value == "*":
+        return ("present", attr, case_exact, None), end + 1
+    if op == "=" and "*" in value:
+        return ("substring", attr, case_exact, [_unescape(v) for v in value.split("*")]), end + 1
+    return (op, attr, case_exact, _unescape(value)), end + 1
+
+def _matches(node, attrs):
+    op = node[0]
+    if op == "&":
+        return all([_matches(c, attrs) for c in node[1]])
+    if op == "|":
+        return any([_matches(c, attrs) for c in node[1]])
+    if op == "!":
+        return not _matches(node[1], attrs)
+
+    op, attr, case_exact, value = node
+    values = attrs.get(attr, [])
+    if op == "present":
+        return len(values) > 0
+
+    values = [_norm_value(attr, v, case_exact) for v in values]
+
+    if op == "substring":
+        if case_exact is None:
+            case_exact = attr in CASE_EXACT
+        parts = value if case_exact else [p.lower() for p in value]
+        pattern = re.compile(".*".join([re.escape(p) for p in parts]) + "$", re.DOTALL)
+        return any([pattern.match("%s" % v) for v in values])
+
+    target = _norm_value(attr, value, case_exact)
+    if op == "=":
+        return target in values
+
+    def comparable(v):
+        # Don't compare ints with strings
+        return type(v) == type(target)
+
+    if op == ">=":
+        return any([v >= target for v in values if comparable(v)])
+    return any([v <= target for v in values if comparable(v)])
+
+def _timestamp():
+    return time.strftime("%Y%m%d%H%M%SZ", time.gmtime())
+
+def _check_password(stored, password):
+    "Check a password against a userPassword value, which may be {SHA} or {SSHA} hashed"
+    stored = ensure_text(stored)
+    password = ensure_bytes(password)
+
+    if stored.startswith("{SHA}"):
+        return base64.b64decode(stored[5:]) == hashlib.sha1(password).digest()
+    if stored.startswith("{SSHA}"):
+        raw = base64.b64decode(stored[6:])
+        digest, salt = raw[:20], raw[20:]
+        return hashlib.sha1(password + salt).digest() == digest
+    return stored == ensure_text(password)
+
+class MemoryBackend(object):
+    """An in-memory directory, with the same interface as sr_ldap.LDAPBackend.
+    Entries are stored as dicts of attribute names to lists of bytes, with
+    hash indexes on the INDEXED attributes and on each entry's parent.
+
+    As with slapd, ``rootdn`` can bind with ``rootpw`` (which may be hashed)
+    without having an entry; other dns need an entry with a userPassword."""
+
+    def __init__(self, rootdn = "cn=Manager,o=sr", rootpw = None):
+        self.rootdn = rootdn
+        self.rootpw = rootpw
+
+        # normalised dn -> (dn, attrs)
+        self._entries = {}
+        # attribute -> normalised value -> set of normalised dns
+        self._indexes = dict([(attr, {}) for attr in INDEXED])
+        # normalised parent dn -> set of normalised dns
+        self._children = {}
+
+        # Results of operations started with the *_ext methods, by msgid
+        self._results = {}
+        self._msgids = itertools.count(1)
+        self._who = None
+        self._lock = threading.RLock()
+
+    # Backend methods (see sr_ldap.LDAPBackend)
+
+    def bind(self, who, cred):
+        self.simple_bind_s(who, cred)
+
+    def unbind(self):
+        self._who = None
+
+    @contextlib.contextmanager
+    def connection(self):
+        yield self
+
+    def read_connection(self):
+        return self.connection()
+
+    def open_connection(self):
+        return self
+
+    def close_connection(self, conn):
+        pass
+
+    def authenticate_async(self, dn, password):
+        try:
+            self.__check_credentials(dn, password)
+        except (ldap.INVALID_CREDENTIALS, ldap.UNWILLING_TO_PERFORM):
+            return _Result(False)
+        return _Result(True)
+
+    # python-ldap methods
+
+    def simple_bind_s(self, who = None, cred = None, serverctrls = None, clientctrls = None):
+        self.__check_credentials(who, cred)
+        self._who = who
+
+    bind_s = simple_bind_s
+
+    def simple_bind(self, who = None, cred = None, serverctrls = None, clientctrls = None):
+        return self.__defer(ldap.RES_BIND, lambda: self.simple_bind_s(who, cred))
+
+    def unbind_s(self):
+        self._who = None
+
+    def whoami_s(self):
+        return "dn:%s" % (self._who or "")
+
+    def search_st(self, base, scope, filterstr = "(objectClass=*)", attrlist = None,
+                  attrsonly = 0, timeout = -1):
+        return self.__search(base, scope, filterstr, attrlist)
+
+    def search_s(self, base, scope, filterstr = "(objectClass=*)", attrlist = None, attrsonly = 0):
+        return self.__search(base, scope, filterstr, attrlist)
+
+    def search_ext_s(self, base, scope, filterstr = "(objectClass=*)", attrlist = None,
+                     attrsonly = 0, serverctrls = None, clientctrls = None,
+                     timeout = -1, sizelimit = 0):
+        return self.__search(base, scope, filterstr, attrlist, sizelimit)
+
+    def search_ext(self, base, scope, filterstr = "(objectClass=*)", attrlist = None,
+                   attrsonly = 0, serverctrls = None, clientctrls = None,
+                   timeout = -1, sizelimit = 0):
+        # Controls such as paging aren't supported, so everything comes back at once
+        return self.__defer( ldap.RES_SEARCH_RESULT,
+                             lambda: self.__search(base, scope, filterstr, attrlist, sizelimit) )
+
+    def add_s(self, dn, modlist):
+        with self._lock:
+            norm = _norm_dn(dn)
+            if norm in self._entries:
+                raise ldap.ALREADY_EXISTS({'desc': "Already exists", 'matched': dn})
+
+            attrs = {}
+            for attr, values in modlist:
+                values = self.__values(values)
+                if len(values) > 0:
+                    attrs.setdefault(attr, []).extend(values)
+
+            now = ensure_bytes(_timestamp())
+            attrs["createTimestamp"] = [now]
+            attrs["modifyTimestamp"] = [now]
+
+            self.__store(norm, ensure_text(dn), attrs)
+
+    def add_ext(self, dn, modlist, serverctrls = None, clientctrls = None):
+        return self.__defer(ldap.RES_ADD, lambda: self.add_s(dn, modlist))
+
+    def modify_s(self, dn, modlist):
+        with self._lock:
+            norm = _norm_dn(dn)
+            if norm not in self._entries:
+                raise ldap.NO_SUCH_OBJECT({'desc': "No such object", 'matched': dn})
+
+            dn, old = self._entries[norm]
+            attrs = dict([(k, list(v)) for k, v in old.items()])
+
+            for op, attr, values in modlist:
+                values = self.__values(values)
+                existing = attrs.get(attr, [])
+                norm_existing = [_norm_value(attr, v) for v in existing]
+
+                if op == ldap.MOD_ADD:
+                    for v in values:
+                        if _norm_value(attr, v) in norm_existing:
+                            raise ldap.TYPE_OR_VALUE_EXISTS({'desc': "Type or value exists", 'info': attr})
+                    attrs[attr] = existing + values
+
+                elif op == ldap.MOD_DELETE:
+                    if len(values) == 0:
+                        if attr not in attrs:
+                            raise ldap.NO_SUCH_ATTRIBUTE({'desc': "No such attribute", 'info': attr})
+                        del attrs[attr]
+                        continue
+
+                    remove = set([_norm_value(attr, v) for v in values])
+                    if not remove.issubset(norm_existing):
+                        raise ldap.NO_SUCH_ATTRIBUTE({'desc': "No such attribute", 'info': attr})
+                    attrs[attr] = [v for v, n in zip(existing, norm_existing) if n not in remove]
+
+                elif op == ldap.MOD_REPLACE:
+                    attrs[attr] = values
+
+                elif op == ldap.MOD_INCREMENT:
+                    if len(existing) != 1:
+                        raise ldap.NO_SUCH_ATTRIBUTE({'desc': "No such attribute", 'info': attr})
+                    by = int(values[0]) if len(values) > 0 else 1
+                    attrs[attr] = [ensure_bytes(str(int(existing[0]) + by))]
+
+                if attr in attrs and len(attrs[attr]) == 0:
+                    del attrs[attr]
+
+            attrs["modifyTimestamp"] = [ensure_bytes(_timestamp())]
+
+            self.__unstore(norm)
+            self.__store(norm, dn, attrs)
+
+    def modify_ext(self, dn, modlist, serverctrls = None, clientctrls = None):
+        return self.__defer(ldap.RES_MODIFY, lambda: self.modify_s(dn, modlist))
+
+    def delete_s(self, dn):
+        with self._lock:
+            norm = _norm_dn(dn)
+            if norm not in self._entries:
+                raise ldap.NO_SUCH_OBJECT({'desc': "No such object", 'matched': dn})
+            self.__unstore(norm)
+
+    def delete_ext(self, dn, serverctrls = None, clientctrls = None):
+        return self.__defer(ldap.RES_DELETE, lambda: self.delete_s(dn))
+
+    def passwd_s(self, user, oldpw, newpw, serverctrls = None, clientctrls = None):
+        self.__check_credentials(user, oldpw)
+        digest = hashlib.sha1(ensure_bytes(newpw)).digest()
+        self.modify_s( user, [(ldap.MOD_REPLACE, "userPassword",
+                               b"{SHA}" + base64.b64encode(digest))] )
+
+    def result3(self, msgid = ldap.RES_ANY, all = 1, timeout = None):
+        with self._lock:
+            if msgid == ldap.RES_ANY:
+                if len(self._results) == 0:
+                    return (None, None, None, None)
+                msgid = min(self._results.keys())
+
+            rtype, result, error = self._results.pop(msgid)
+
+        if error is not None:
+            raise error
+        return (rtype, result or [], msgid, [])
+
+    def abandon(self, msgid):
+        with self._lock:
+            self._results.pop(msgid, None)
+
+    # Internals
+
+    def __defer(self, rtype, operation):
+        "Run an operation straight away, keeping its result for result3"
+        msgid = next(self._msgids)
+        try:
+            result = (rtype, operation(), None)
+        except ldap.LDAPError as e:
+            result = (rtype, None, e)
+
+        with self._lock:
+            self._results[msgid] = result
+        return msgid
+
+    def __values(self, values):
+        if values is None:
+            return []
+        if not isinstance(values, list):
+            values = [values]
+        return [ensure_bytes(v) for v in values]
+
+    def __store(self, norm, dn, attrs):
+        self._entries[norm] = (dn, attrs)
+        self._children.setdefault(_parent(norm), set()).add(norm)
+
+        for attr in INDEXED:
+            index = self._indexes[attr]
+            for v in attrs.get(attr, []):
+                index.setdefault(_norm_value(attr, v), set()).add(norm)
+
+    def __unstore(self, norm):
+        dn, attrs = self._entries.pop(norm)
+        self._children[_parent(norm)].discard(norm)
+
+        for attr in INDEXED:
+            index = self._indexes[attr]
+            for v in attrs.get(attr, []):
+                key = _norm_value(attr, v)
+                index[key].discard(norm)
+                if len(index[key]) == 0:
+                    del index[key]
+
+    def __candidates(self, node):
+        """The normalised dns of the entries which could match the filter, from
+        the indexes, or None if the indexes can't narrow it down"""
+        op = node[0]
+
+        if op == "=":
+            attr, case_exact = node[1], node[2]
+            if attr not in self._indexes:
+                return None
+            if case_exact is not None and case_exact != (attr in CASE_EXACT):
+                # Not the matching rule the index was built with; an exact
+                # match is still a subset of a case insensitive one though
+                if case_exact and attr not in INTEGERS:
+                    return set(self._indexes[attr].get(node[3].lower(), ()))
+                return None
+            return set(self._indexes[attr].get(_norm_value(attr, node[3]), ()))
+
+        if op == "&":
+            best = None
+            for child in node[1]:
+                c = self.__candidates(child)
+                if c is not None and (best is None or len(c) < len(best)):
+                    best = c
+            return best
+
+        if op == "|":
+            result = set()
+            for child in node[1]:
+                c = self.__candidates(child)
+                if c is None:
+                    return None
+                result |= c
+            return result
+
+        return None
+
+    def __search(self, base, scope, filterstr, attrlist, sizelimit = 0):
+        tree = parse_filter(ensure_text(filterstr))
+        norm_base = _norm_dn(base)
+
+        with self._lock:
+            if scope == ldap.SCOPE_BASE:
+                in_scope = set([norm_base]) if norm_base in self._entries else set()
+            elif scope == ldap.SCOPE_ONELEVEL:
+                in_scope = self._children.get(norm_base, set())
+            else:
+                in_scope = None
+
+            candidates = self.__candidates(tree)
+            if candidates is None:
+                candidates = in_scope if in_scope is not None else self._entries.keys()
+            elif in_scope is not None:
+                candidates = candidates & in_scope
+
+            results = []
+            for norm in candidates:
+                if in_scope is None and not (norm == norm_base or norm.endswith("," + norm_base)):
+                    continue
+
+                dn, attrs = self._entries[norm]
+                if not _matches(tree, attrs):
+                    continue
+
+                results.append( (dn, self.__project(attrs, attrlist)) )
+                if sizelimit > 0 and len(results) >= sizelimit:
+                    break
+
+            return results
+
+    def __project(self, attrs, attrlist):
+        "Copy the requested attributes of an entry, as a search would return them"
+        if attrlist is None or "*" in attrlist:
+            wanted = [a for a in attrs if a not in OPERATIONAL]
+            if attrlist is not None:
+                wanted.extend([a for a in attrlist if a in OPERATIONAL])
+        else:
+            lower = set([a.lower() for a in attrlist])
+            wanted = [a for a in attrs if a.lower() in lower]
+
+        return dict([(a, list(attrs[a])) for a in wanted if a in attrs])
+
+    def __check_credentials(self, who, cred):
+        "Check the password for a dn, failing as slapd would"
+        if not who and not cred:
+            # An anonymous bind
+            return
+
+        if not cred:
+            raise ldap.UNWILLING_TO_PERFORM({'desc': "Unauthenticated bind not allowed"})
+
+        if self.rootdn is not None and _norm_dn(who) == _norm_dn(self.rootdn):
+            stored = [] if self.rootpw is None else [self.rootpw]
+        else:
+            with self._lock:
+                entry = self._entries.get(_norm_dn(who or ""))
+            stored = [] if entry is None else entry[1].get("userPassword", [])
+
+        for s in stored:
+            if _check_password(s, cred):
+                return
+        raise ldap.INVALID_CREDENTIALS({'desc': "Invalid credentials"})
+
+class _Result(object):
+    "An already finished authenticate_async"
+
+    def __init__(self, result):
+        self._result = result
+
+    def result(self, timeout = None):
+        return self._result
@@ -0,0 +1,299 @@
+"""
+Instrumentation of the calls made to the directory.
+
+Every call made through sr_ldap.get_conn() (or a connection from
+sr_ldap.connection()) is recorded: how long it took, how many entries
+and bytes it returned or sent, and which srusers function made it. The
+totals are available from snapshot() or, in the Prometheus text format,
+from prometheus_text(); sinks added with add_sink() are called with each
+call as it happens, and request() counts the calls made within a block:
+
+    with metrics.request() as r:
+        render_page()
+    log(r.summary())    # "12 searches, 1 modify costing 48.2 ms"
+"""
+
+from __future__ import unicode_literals
+
+import contextlib
+import sys
+import threading
+import time
+
+from .config import config
+
+timer = getattr(time, "perf_counter", time.time)
+
+# Upper bounds (in seconds) of the latency histogram buckets
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Methods which aren't operations on the directory
+_IGNORED = set(["bind", "unbind", "connection", "open_connection",
+                "close_connection", "authenticate_async", "fileno"])
+
+# Modules whose functions aren't reported as the caller (contextlib, as
+# batched writes are sent from the __exit__ of the batch() block)
+_INTERNAL = set(["sr_ldap", "metrics", "memory", "bench", "contextlib"])
+
+# Anonymous functions, which are reported as the function they're in
+# (e.g. the lambdas which start each operation given to sr_ldap.pipeline)
+_ANONYMOUS = set(["<lambda>", "<listcomp>", "<genexpr>", "<dictcomp>", "<setcomp>"])
+
+def _operation(method):
+    "The operation a python-ldap method performs, e.g. search_st -> search"
+    if method.startswith("result"):
+        return "result"
+    for suffix in ("_ext_s", "_ext", "_st", "_s"):
+        if method.endswith(suffix):
+            return method[:-len(suffix)]
+    return method
+
+def _caller():
+    "The srusers (or other) function which called into the directory"
+    frame = sys._getframe(2)
+    while frame is not None:
+        module = frame.f_globals.get("__name__", "").split(".")[-1]
+        if module not in _INTERNAL and frame.f_code.co_name not in _ANONYMOUS:
+            return "%s.%s" % (module, frame.f_code.co_name)
+        frame = frame.f_back
+    return "unknown"
+
+def _size(data):
+    "Count the entries and bytes in a search result or modlist"
+    entries = 0
+    nbytes = 0
+
+    if isinstance(data, tuple) and len(data) == 4:
+        # The result of result3
+        data = data[1]
+
+    if isinstance(data, list):
+        for item in data:
+            if isinstance(item, tuple) and len(item) == 2 and isinstance(item[1], dict):
+                # A search result entry
+                entries += 1
+                nbytes += len(item[0] or "")
+                for values in item[1].values():
+                    nbytes += sum([len(v) for v in values])
+            elif isinstance(item, tuple) and len(item) in (2, 3):
+                # A modlist item
+                values = item[-1]
+                if isinstance(values, list):
+                    nbytes += sum([len(v) for v in values if v is not None])
+                elif values is not None:
+                    nbytes += len(values)
+
+    return entries, nbytes
+
+class _Series(object):
+    "The totals for one operation from one caller"
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self.entries = 0
+        self.bytes = 0
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+    def add(self, event):
+        self.count += 1
+        if event["error"] is not None:
+            self.errors += 1
+        self.seconds += event["seconds"]
+        self.entries += event["entries"]
+        self.bytes += event["bytes"]
+
+        for i, bound in enumerate(BUCKETS):
+            if event["seconds"] <= bound:
+                self.buckets[i] += 1
+                break
+        else:
+            self.buckets[-1] += 1
+
+class Metrics(object):
+    "Totals of the calls made to the directory, by operation and caller"
+
+    def __init__(self):
+        self._series = {}
+        self._sinks = []
+        self._lock = threading.Lock()
+
+    def record(self, event):
+        with self._lock:
+            key = (event["operation"], event["caller"])
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = _Series()
+            series.add(event)
+            sinks = list(self._sinks)
+
+        for sink in sinks:
+            sink(event)
+
+    def add_sink(self, fn):
+        """Call fn with a dict describing each call to the directory, with
+        keys "operation", "method", "caller", "seconds", "entries", "bytes"
+        and "error" (the exception raised, or None)"""
+        with self._lock:
+            self._sinks.append(fn)
+
+    def remove_sink(self, fn):
+        with self._lock:
+            self._sinks.remove(fn)
+
+    def reset(self):
+        with self._lock:
+            self._series = {}
+
+    def snapshot(self):
+        "Returns a list of dicts of the totals for each operation and caller"
+        with self._lock:
+            result = []
+            for (operation, caller), s in sorted(self._series.items()):
+                result.append({ "operation": operation,
+                                "caller": caller,
+                                "count": s.count,
+                                "errors": s.errors,
+                                "seconds": s.seconds,
+                                "entries": s.entries,
+                                "bytes": s.bytes,
+                                "buckets": list(s.buckets) })
+            return result
+
+    def prometheus_text(self):
+        "The totals in the Prometheus text exposition format"
+        lines = [ "# HELP srusers_ldap_operation_seconds Time taken by directory operations.",
+                  "# TYPE srusers_ldap_operation_seconds histogram" ]
+
+        snapshot = self.snapshot()
+        for s in snapshot:
+            labels = 'operation="%s",caller="%s"' % (s["operation"], s["caller"])
+            cumulative = 0
+            for bound, n in zip(BUCKETS, s["buckets"]):
+                cumulative += n
+                lines.append('srusers_ldap_operation_seconds_bucket{%s,le="%s"} %i' % (labels, bound, cumulative))
+            lines.append('srusers_ldap_operation_seconds_bucket{%s,le="+Inf"} %i' % (labels, s["count"]))
+            lines.append('srusers_ldap_operation_seconds_sum{%s} %f' % (labels, s["seconds"]))
+            lines.append('srusers_ldap_operation_seconds_count{%s} %i' % (labels, s["count"]))
+
+        for name, key, help in [ ("errors", "errors", "Directory operations which failed."),
+                                 ("entries", "entries", "Entries returned by directory operations."),
+                                 ("bytes", "bytes", "Attribute bytes sent or returned by directory operations.") ]:
+            lines.append("# HELP srusers_ldap_%s_total %s" % (name, help))
+            lines.append("# TYPE srusers_ldap_%s_total counter" % (name))
+            for s in snapshot:
+                lines.append('srusers_ldap_%s_total{operation="%s",caller="%s"} %i'
+                             % (name, s["operation"], s["caller"], s[key]))
+
+        return "\n".join(lines) + "\n"
+
+class Request(object):
+    "The calls to the directory made within a metrics.request() block"
+
+    def __init__(self):
+        self.counts = {}
+        self.seconds = 0.0
+
+    def add(self, event):
+        op = event["operation"]
+        self.counts[op] = self.counts.get(op, 0) + 1
+        self.seconds += event["seconds"]
+
+    @property
+    def round_trips(self):
+        "The number of requests sent to the server (collecting results isn't one)"
+        return sum([n for op, n in self.counts.items() if op != "result"])
+
+    def summary(self):
+        parts = []
+        for op, n in sorted(self.counts.items()):
+            if op == "result":
+                continue
+            plural = "es" if op.endswith("h") else "s"
+            parts.append("%i %s%s" % (n, op, plural if n != 1 else ""))
+
+        if len(parts) == 0:
+            parts = ["no directory calls"]
+        return "%s costing %.1f ms" % (", ".join(parts), self.seconds * 1000)
+
+_local = threading.local()
+
+@contextlib.contextmanager
+def request():
+    "Context manager giving a Request which records the calls made in this thread"
+    r = Request()
+    stack = getattr(_local, "requests", None)
+    if stack is None:
+        stack = _local.requests = []
+
+    stack.append(r)
+    try:
+        yield r
+    finally:
+        stack.remove(r)
+
+registry = Metrics()
+
+class Instrumented(object):
+    "Wraps a backend or connection, recording each call made through it"
+
+    def __init__(self, target):
+        self._target = target
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if name.startswith("_") or name in _IGNORED or not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            start = timer()
+            error = None
+            result = None
+            try:
+                result = attr(*args, **kwargs)
+                return result
+            except Exception as e:
+                error = e
+                raise
+            finally:
+                seconds = timer() - start
+                sent = args[-1] if name.startswith(("add", "modify")) and len(args) > 0 else None
+                entries, nbytes = _size(result if sent is None else sent)
+                _record( { "operation": _operation(name),
+                           "method": name,
+                           "caller": _caller(),
+                           "seconds": seconds,
+                           "entries": entries,
+                           "bytes": nbytes,
+                           "error": error } )
+        return call
+
+def _record(event):
+    registry.record(event)
+    for r in getattr(_local, "requests", ()):
+        r.add(event)
+
+_enabled = None
+
+def instrument(target):
+    "Wrap a backend or connection so the calls made with it are recorded"
+    global _enabled
+
+    if _enabled is None:
+        _enabled = config.getboolean('metrics', 'enabled')
+    if not _enabled:
+        return target
+    return Instrumented(target)
+
+def add_sink(fn):
+    registry.add_sink(fn)
+
+def remove_sink(fn):
+    registry.remove_sink(fn)
+
+def snapshot():
+    return registry.snapshot()
+
+def prometheus_text():
+    return registry.prometheus_text()
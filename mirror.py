@@ -0,0 +1,356 @@
+"""
+A local copy of the users and groups in the directory, kept up to date
+using RFC 4533 content synchronisation (syncrepl) in refreshAndPersist
+mode, from which the common read operations can be answered without
+going to the server.
+
+The mirror's contents and the sync cookie are optionally saved to disk,
+so that after a restart only the changes since then need fetching.
+"""
+
+from __future__ import unicode_literals
+
+import fnmatch
+import ldap
+import logging
+import os
+import pickle
+import re
+import threading
+import time
+
+from . import sr_ldap
+from .config import config
+from .sr_ldap import ensure_text
+
+logger = logging.getLogger(__name__)
+
+USERS_DN = "ou=users,o=sr"
+GROUPS_DN = "ou=groups,o=sr"
+
+# The attributes of users and groups which the mirror serves. Others (in
+# particular userPassword) are neither fetched nor saved to the state file.
+USER_ATTRS = ["objectClass", "uid", "cn", "sn", "mail", "uidNumber",
+              "gidNumber", "homeDirectory", "loginShell"]
+GROUP_ATTRS = ["objectClass", "cn", "gidNumber", "description", "memberUid"]
+ATTRS = USER_ATTRS + [a for a in GROUP_ATTRS if a not in USER_ATTRS]
+
+def _parent(dn):
+    return dn.split(",", 1)[-1].replace(" ", "").lower()
+
+def _first(attrs, name):
+    return ensure_text(attrs[name][0]) if name in attrs else None
+
+class MirrorStore(object):
+    """The mirrored entries, indexed by their syncrepl uuid, along with
+    indexes of users by uid and groups by name and by member."""
+
+    def __init__(self):
+        self.cookie = None
+        # uuid -> (dn, attrs)
+        self._users = {}
+        self._groups = {}
+        # lowercase uid -> uuid, lowercase cn -> uuid, member username -> set of group uuids
+        self._uids = {}
+        self._cns = {}
+        self._members = {}
+        self._lock = threading.RLock()
+
+    def put(self, uuid, dn, attrs):
+        attrs = dict([(name, values) for name, values in attrs.items() if name in ATTRS])
+
+        with self._lock:
+            self.remove(uuid)
+
+            parent = _parent(dn)
+            if parent == USERS_DN:
+                self._users[uuid] = (dn, attrs)
+                uid = _first(attrs, "uid")
+                if uid is not None:
+                    self._uids[uid.lower()] = uuid
+
+            elif parent == GROUPS_DN:
+                self._groups[uuid] = (dn, attrs)
+                cn = _first(attrs, "cn")
+                if cn is not None:
+                    self._cns[cn.lower()] = uuid
+                for member in self.__members_of(attrs):
+                    self._members.setdefault(member, set()).add(uuid)
+
+    def remove(self, uuid):
+        with self._lock:
+            if uuid in self._users:
+                dn, attrs = self._users.pop(uuid)
+                uid = _first(attrs, "uid")
+                if uid is not None and self._uids.get(uid.lower()) == uuid:
+                    del self._uids[uid.lower()]
+
+            elif uuid in self._groups:
+                dn, attrs = self._groups.pop(uuid)
+                cn = _first(attrs, "cn")
+                if cn is not None and self._cns.get(cn.lower()) == uuid:
+                    del self._cns[cn.lower()]
+                for member in self.__members_of(attrs):
+                    groups = self._members.get(member, set())
+                    groups.discard(uuid)
+                    if len(groups) == 0:
+                        self._members.pop(member, None)
+
+    def uuids(self):
+        with self._lock:
+            return set(self._users.keys()) | set(self._groups.keys())
+
+    def user_entries(self):
+        with self._lock:
+            return [self._users[u] for u in self._users]
+
+    def user_entry(self, username):
+        with self._lock:
+            uuid = self._uids.get(username.lower())
+            return None if uuid is None else self._users[uuid]
+
+    def search_users(self, criteria):
+        """Find the users whose attributes equal all of the given values,
+        which are compared case insensitively as most of the attributes are"""
+        criteria = dict((k, ("%s" % ensure_text(v)).lower()) for k, v in criteria.items())
+
+        with self._lock:
+            if "uid" in criteria:
+                entry = self.user_entry(criteria["uid"])
+                candidates = [] if entry is None else [entry]
+            else:
+                candidates = self._users.values()
+
+            def matches(attrs):
+                for name, value in criteria.items():
+                    values = [v.lower() for v in ensure_text(attrs.get(name, []))]
+                    if value not in values:
+                        return False
+                return True
+
+            return [(dn, attrs) for dn, attrs in candidates if matches(attrs)]
+
+    def group_names(self, name_filter = None):
+        "The names of the groups, optionally matching a filter which may contain '*'"
+        with self._lock:
+            names = [_first(attrs, "cn") for dn, attrs in self._groups.values()]
+
+        if name_filter is None:
+            return names
+
+        pattern = re.compile(fnmatch.translate(name_filter), re.IGNORECASE)
+        return [n for n in names if pattern.match(n)]
+
+    def groups_of(self, username):
+        with self._lock:
+            uuids = self._members.get(username, ())
+            return sorted([_first(self._groups[u][1], "cn") for u in uuids])
+
+    def save(self, path):
+        """Save the entries and cookie, replacing the file atomically.
+        The file is only readable by its owner."""
+        with self._lock:
+            state = (self.cookie, self._users, self._groups)
+            tmp = "%s.tmp" % path
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            with os.fdopen(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), "wb") as f:
+                pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp, path)
+
+    def load(self, path):
+        # Unpickling runs code from the file, so only trust one nobody else can write
+        st = os.stat(path)
+        if st.st_uid != os.getuid() or st.st_mode & 0o022:
+            raise Exception("Mirror state file '%s' is writable by other users" % (path))
+
+        with self._lock:
+            with open(path, "rb") as f:
+                cookie, users, groups = pickle.load(f)
+
+            for entries in (users, groups):
+                for uuid, (dn, attrs) in entries.items():
+                    self.put(uuid, dn, attrs)
+            self.cookie = cookie
+
+    def __members_of(self, attrs):
+        members = []
+        for value in ensure_text(attrs.get("memberUid", [])):
+            if value.startswith("uid=") and "," in value:
+                value = value.split(",")[0][len("uid="):]
+            members.append(value)
+        return members
+
+def _consumer_class():
+    "Build the syncrepl consumer class; delayed as ldap.syncrepl needs pyasn1"
+    from ldap.ldapobject import ReconnectLDAPObject
+    from ldap.syncrepl import SyncreplConsumer
+
+    class Consumer(ReconnectLDAPObject, SyncreplConsumer):
+        "Applies the changes sent by the server to a Mirror"
+
+        def __init__(self, uri, mirror):
+            ReconnectLDAPObject.__init__(self, uri, bytes_mode = False)
+            self.mirror = mirror
+            self.present = set()
+
+        def syncrepl_get_cookie(self):
+            return self.mirror.store.cookie
+
+        def syncrepl_set_cookie(self, cookie):
+            self.mirror.store.cookie = cookie
+            self.mirror._changed()
+
+        def syncrepl_entry(self, dn, attributes, uuid):
+            self.present.add(uuid)
+            self.mirror.store.put(uuid, dn, attributes)
+
+        def syncrepl_delete(self, uuids):
+            for uuid in uuids:
+                self.mirror.store.remove(uuid)
+
+        def syncrepl_present(self, uuids, refreshDeletes = False):
+            if uuids is None:
+                # The end of the present phase: anything not mentioned is gone
+                if refreshDeletes is False:
+                    self.syncrepl_delete(self.mirror.store.uuids() - self.present)
+                self.present = set()
+            elif refreshDeletes:
+                self.syncrepl_delete(uuids)
+            else:
+                self.present.update(uuids)
+
+        def syncrepl_refreshdone(self):
+            self.mirror._refreshed()
+
+    return Consumer
+
+class Mirror(object):
+    """Keeps a MirrorStore up to date from a background thread.
+    Args: state_file = where to save the entries and cookie, or None
+          save_interval = how often (in seconds) to save them"""
+
+    def __init__(self, state_file = None, save_interval = 60):
+        self.state_file = state_file
+        self.save_interval = save_interval
+        self.store = MirrorStore()
+
+        self._ready = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._dirty = False
+        self._last_save = 0
+
+        if state_file is not None and os.path.exists(state_file):
+            try:
+                self.store.load(state_file)
+            except Exception:
+                logger.exception("Could not load the mirror state from %s", state_file)
+                self.store = MirrorStore()
+
+    @property
+    def ready(self):
+        "Whether the initial refresh has finished, so the mirror can be read"
+        return self._ready.is_set()
+
+    def wait(self, timeout = None):
+        "Wait for the initial refresh to finish"
+        return self._ready.wait(timeout)
+
+    def start(self):
+        self._thread = threading.Thread(target = self.__run, name = "srusers-mirror")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.__save()
+
+    def _changed(self):
+        self._dirty = True
+        if time.time() - self._last_save > self.save_interval:
+            self.__save()
+
+    def _refreshed(self):
+        self._ready.set()
+        self.__save()
+
+    def __save(self):
+        if self.state_file is None or not self._dirty:
+            return
+        try:
+            self.store.save(self.state_file)
+        except (IOError, OSError):
+            logger.exception("Could not save the mirror state to %s", self.state_file)
+            return
+        self._dirty = False
+        self._last_save = time.time()
+
+    def __run(self):
+        consumer_class = _consumer_class()
+        delay = 1
+
+        while not self._stop.is_set():
+            conn = None
+            try:
+                sr_ldap.bind()
+                conn = consumer_class( "ldap://%s/" % config.get('ldap', 'host'), self )
+                if sr_ldap.credentials is not None:
+                    conn.simple_bind_s( *sr_ldap.credentials )
+
+                msgid = conn.syncrepl_search( "o=sr",
+                                              ldap.SCOPE_SUBTREE,
+                                              mode = "refreshAndPersist",
+                                              filterstr = "(|(objectClass=inetOrgPerson)(objectClass=posixGroup))",
+                                              attrlist = ATTRS )
+                delay = 1
+
+                while not self._stop.is_set():
+                    try:
+                        if not conn.syncrepl_poll( msgid = msgid, all = 1, timeout = 1 ):
+                            logger.warning("Directory mirror's search was ended by the server; restarting in %is", delay)
+                            break
+                    except ldap.TIMEOUT:
+                        pass
+
+            except ldap.LDAPError:
+                logger.exception("Directory mirror lost its connection; retrying in %is", delay)
+
+            finally:
+                if conn is not None:
+                    try:
+                        conn.unbind_s()
+                    except ldap.LDAPError:
+                        pass
+
+            self._stop.wait(delay)
+            delay = min(delay * 2, 60)
+
+_mirror = None
+_mirror_lock = threading.Lock()
+
+def get_mirror():
+    """Get the shared mirror, starting it if it's enabled in the [mirror]
+    section of the config. Returns None if it's disabled."""
+    global _mirror
+
+    if not config.getboolean('mirror', 'enabled'):
+        return None
+
+    with _mirror_lock:
+        if _mirror is None:
+            state_file = config.get('mirror', 'state_file') or None
+            _mirror = Mirror( state_file, config.getint('mirror', 'save_interval') )
+            _mirror.start()
+
+    return _mirror
+
+def active():
+    """Returns the mirror's MirrorStore if the mirror is enabled and ready to
+    be read from, otherwise None"""
+    m = get_mirror()
+    if m is not None and m.ready:
+        return m.store
+    return None
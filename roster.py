@@ -0,0 +1,136 @@
+"""
+Rosters of the members of team and college groups, with their details and
+the other groups they're in, as needed to show who's in a team or college.
+
+Each roster is built from the membership index and a search for the members'
+entries, and then kept (for up to the [rosters] ttl) until one of its
+members or its group is saved.
+"""
+
+from __future__ import unicode_literals
+
+import threading
+import time
+
+from . import membership
+from .config import config
+from .constants import COLLEGE_PREFIX, TEAM_PREFIX
+
+class roster_member(object):
+    "A member of a roster: their users.user_record, and the groups they're in"
+
+    __slots__ = ("user", "groups")
+
+    def __init__(self, user, groups):
+        self.user = user
+        self.groups = groups
+
+    @property
+    def username(self):
+        return self.user.username
+
+    @property
+    def lang(self):
+        "The user's language, from their lang- group"
+        # Delayed import to avoid circular dependency
+        from .users import lang_from_groups
+        return lang_from_groups(self.groups)
+
+    def __repr__(self):
+        return "<roster_member %s>" % (self.username)
+
+class RosterViews(object):
+    """The rosters which have been built, kept for at most ``ttl`` seconds
+    or until they're invalidated. A ttl of 0 disables keeping them."""
+
+    def __init__(self, ttl = 60):
+        self.ttl = ttl
+        # lowercase group name -> (time built, list of roster_members, set of usernames)
+        self._views = {}
+        self._lock = threading.Lock()
+
+    def get(self, name):
+        """The members of the named group, as a list of roster_members sorted
+        by username, or None if there's no such group"""
+        key = name.lower()
+        with self._lock:
+            view = self._views.get(key)
+            if view is not None and time.time() - view[0] <= self.ttl:
+                return view[1]
+
+        built = time.time()
+        members = self.__build(name)
+
+        if members is not None and self.ttl > 0:
+            with self._lock:
+                self._views[key] = (built, members, set([m.username.lower() for m in members]))
+
+        return members
+
+    def invalidate_group(self, name, usernames = ()):
+        """Drop the group's roster, and those including any of the given
+        users (whose memberships have changed)"""
+        with self._lock:
+            self._views.pop(name.lower(), None)
+        self.invalidate_users(usernames)
+
+    def invalidate_users(self, usernames):
+        "Drop the rosters which include any of the users"
+        usernames = set([u.lower() for u in usernames])
+        if len(usernames) == 0:
+            return
+
+        with self._lock:
+            for key, view in list(self._views.items()):
+                if not usernames.isdisjoint(view[2]):
+                    del self._views[key]
+
+    def clear(self):
+        with self._lock:
+            self._views.clear()
+
+    def __build(self, name):
+        # Delayed import to avoid circular dependency
+        from .users import user
+
+        index = membership.get_index()
+        usernames = index.members_of(name)
+        if usernames is None:
+            return None
+
+        records, missing = user.load_records(usernames, match_case = True)
+        groups = index.memberships([r.username for r in records])
+
+        return [roster_member(r, groups[r.username])
+                for r in sorted(records, key = lambda r: r.username)]
+
+_views = None
+
+def get_views():
+    "Get the shared roster views, configured from the [rosters] section of the config"
+    global _views
+
+    if _views is None:
+        _views = RosterViews( config.getint('rosters', 'ttl') )
+
+    return _views
+
+def team(team_id):
+    "The roster of a team, given its id with or without the team- prefix"
+    if not team_id.startswith(TEAM_PREFIX):
+        team_id = TEAM_PREFIX + team_id
+    return get_views().get(team_id)
+
+def college(college_id):
+    "The roster of a college, given its id with or without the college- prefix"
+    if not college_id.startswith(COLLEGE_PREFIX):
+        college_id = COLLEGE_PREFIX + college_id
+    return get_views().get(college_id)
+
+def invalidate_user(username):
+    if _views is not None:
+        _views.invalidate_users([username])
+
+def invalidate_group(name, usernames = ()):
+    if _views is not None:
+        _views.invalidate_group(name, usernames)
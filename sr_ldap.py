@@ -5,10 +5,20 @@ try:
 except ImportError:
     from configparser import NoOptionError
 
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import collections
+import contextlib
 import getpass
 import ldap
 import sys
+import threading
+import time
 
+from . import metrics
 from .config import config
 
 try:
@@ -16,8 +26,13 @@ try:
 except NameError:
     unicode = str
 
-conn = None
+pool = None
+auth_pool = None
+replica_pools = {}
+router = None
+backend = None
 bound = False
+credentials = None
 
 def ensure_text(data):
     if isinstance(data, bytes):
@@ -33,30 +48,975 @@ def ensure_bytes(data):
         return [ensure_bytes(x) for x in data]
     return data
 
-def connect():
-    global conn
-    conn_str = "ldap://%s/" % config.get('ldap', 'host')
-    conn = ldap.initialize(conn_str, bytes_mode=False)
+def connect(host = None):
+    "Open a new, unbound, connection to the LDAP server (by default the master)"
+    if host is None:
+        host = config.get('ldap', 'host')
+    conn_str = "ldap://%s/" % host
+    return ldap.initialize(conn_str, bytes_mode=False)
 
-if conn == None:
-    connect()
+def _new_conn(host = None):
+    "Open a new connection, bound with the current credentials (if any)"
+    conn = connect(host)
+    if credentials is not None:
+        conn.simple_bind_s( credentials[0], credentials[1] )
+    return conn
 
-def default_pass():
+class ConnectionPool(object):
+    """A pool of LDAP connections.
+
+    Connections are checked out for the duration of an operation and then
+    returned for re-use by other threads. At most ``size`` connections are
+    open at once; connections idle for longer than ``idle_timeout`` seconds
+    are closed, and ones idle for longer than ``check_interval`` seconds are
+    checked to still be alive before being handed out again."""
+
+    def __init__(self, factory, size = 4, idle_timeout = 300, check_interval = 30):
+        self.factory = factory
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.check_interval = check_interval
+
+        # Stack of (connection, last used time) pairs, most recent last
+        self._idle = []
+        # Generation of each checked out connection, keyed by id()
+        self._out = {}
+        self._created = 0
+        self._generation = 0
+        self._cond = threading.Condition()
+
+    def checkout(self, timeout = None):
+        """Get a connection from the pool, opening a new one if there's
+        space, otherwise waiting up to ``timeout`` seconds for one."""
+        while True:
+            conn, last_used = self.__take(timeout)
+
+            if conn is None:
+                try:
+                    conn = self.factory()
+                except:
+                    self.__forget(None)
+                    raise
+            elif time.time() - last_used > self.check_interval \
+                    and not self.__healthy(conn):
+                self.discard(conn)
+                continue
+
+            with self._cond:
+                self._out[id(conn)] = self._generation
+            return conn
+
+    def checkin(self, conn):
+        "Return a connection to the pool"
+        with self._cond:
+            generation = self._out.pop(id(conn), None)
+            if generation != self._generation:
+                # The pool was cleared while this was checked out
+                self._created -= 1
+                self._cond.notify()
+                _close(conn)
+                return
+
+            self._idle.append( (conn, time.time()) )
+            self._cond.notify()
+
+    def discard(self, conn):
+        "Close a checked out connection rather than returning it to the pool"
+        self.__forget(conn)
+        _close(conn)
+
+    def clear(self):
+        """Close all the idle connections. Connections which are currently
+        checked out are closed when they are returned."""
+        with self._cond:
+            idle = self._idle
+            self._idle = []
+            self._created -= len(idle)
+            self._generation += 1
+            self._cond.notify_all()
+
+        for conn, last_used in idle:
+            _close(conn)
+
+    @contextlib.contextmanager
+    def connection(self, timeout = None):
+        "Context manager which checks out a connection for its duration"
+        conn = self.checkout(timeout)
+        try:
+            yield conn
+        except (ldap.SERVER_DOWN, ldap.TIMEOUT):
+            # It's gone, or may still have the result of the call to come
+            self.discard(conn)
+            raise
+        except:
+            self.checkin(conn)
+            raise
+        else:
+            self.checkin(conn)
+
+    def __take(self, timeout):
+        "Pop an idle connection, or reserve space for a new one (None)"
+        deadline = None if timeout is None else time.time() + timeout
+        expired = []
+
+        with self._cond:
+            try:
+                while True:
+                    expired.extend(self.__reap())
+
+                    if len(self._idle) > 0:
+                        return self._idle.pop()
+
+                    if self._created < self.size:
+                        self._created += 1
+                        return (None, None)
+
+                    remaining = None
+                    if deadline is not None:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            raise ldap.TIMEOUT({'desc': "No free LDAP connections in the pool"})
+                    self._cond.wait(remaining)
+            finally:
+                for conn, last_used in expired:
+                    _close(conn)
+
+    def __reap(self):
+        "Remove connections which have been idle for too long. Call with the lock held."
+        cutoff = time.time() - self.idle_timeout
+        expired = [x for x in self._idle if x[1] < cutoff]
+        if len(expired) > 0:
+            self._idle = [x for x in self._idle if x[1] >= cutoff]
+            self._created -= len(expired)
+        return expired
+
+    def __forget(self, conn):
+        with self._cond:
+            if conn is not None:
+                self._out.pop(id(conn), None)
+            self._created -= 1
+            self._cond.notify()
+
+    def __healthy(self, conn):
+        try:
+            conn.whoami_s()
+        except ldap.LDAPError:
+            return False
+        return True
+
+def _close(conn):
     try:
-        passwd = config.get('ldap', 'password')
-    except NoOptionError:
-        sys.stderr.write("LDAP Password:")
-        passwd = getpass.getpass("")
+        conn.unbind_s()
+    except ldap.LDAPError:
+        pass
+
+def get_pool():
+    "Get the connection pool, creating it if needed"
+    global pool
+
+    if pool is None:
+        pool = ConnectionPool( _new_conn,
+                               size = config.getint('ldap', 'pool_size'),
+                               idle_timeout = config.getint('ldap', 'pool_idle_timeout'),
+                               check_interval = config.getint('ldap', 'pool_check_interval') )
+    return pool
+
+_replica_lock = threading.Lock()
+
+def get_replica_pool(host):
+    "Get the connection pool for a replica, creating it if needed"
+    with _replica_lock:
+        if host not in replica_pools:
+            replica_pools[host] = ConnectionPool( lambda: _new_conn(host),
+                                                  size = config.getint('ldap', 'pool_size'),
+                                                  idle_timeout = config.getint('ldap', 'pool_idle_timeout'),
+                                                  check_interval = config.getint('ldap', 'pool_check_interval') )
+        return replica_pools[host]
+
+def _clear_pools():
+    "Close the connections to the master and the replicas"
+    get_pool().clear()
+    with _replica_lock:
+        pools = list(replica_pools.values())
+    for p in pools:
+        p.clear()
+
+class ReplicaRouter(object):
+    """Chooses which server each search goes to: the replica which has been
+    answering fastest, or the master if none of the replicas are up.
+
+    A replica which fails is left alone for ``retry_interval`` seconds. One
+    which hasn't been used for ``probe_interval`` seconds is tried next, so
+    that replicas which were slow get measured again."""
+
+    # Weight given to the latest time taken, in the moving average of them
+    ALPHA = 0.3
+
+    def __init__(self, master, replicas, probe_interval = 30, retry_interval = 30):
+        self.master = master
+        self.replicas = [h for h in replicas]
+        self.probe_interval = probe_interval
+        self.retry_interval = retry_interval
+
+        self._latency = dict([(h, 0.0) for h in self.replicas])
+        self._last_used = dict([(h, 0) for h in self.replicas])
+        self._down_until = {}
+        # The times taken by recent searches on any replica
+        self._samples = collections.deque(maxlen = 200)
+        self._lock = threading.Lock()
+
+    def choose(self, exclude = ()):
+        "The host to send the next search to, other than those in exclude"
+        now = time.time()
+        with self._lock:
+            up = [h for h in self.replicas
+                  if self._down_until.get(h, 0) <= now and h not in exclude]
+            if len(up) == 0:
+                return self.master
+
+            stale = [h for h in up if now - self._last_used[h] > self.probe_interval]
+            if len(stale) > 0:
+                host = stale[0]
+            else:
+                host = min(up, key = lambda h: self._latency[h])
+
+            self._last_used[host] = now
+            return host
+
+    def record(self, host, seconds):
+        "Record how long a search on a replica took"
+        with self._lock:
+            if host in self._latency:
+                self._latency[host] += self.ALPHA * (seconds - self._latency[host])
+                self._samples.append(seconds)
+
+    def percentile(self, p):
+        "The time within which p% of recent searches finished, or None if there have been too few"
+        with self._lock:
+            samples = sorted(self._samples)
+        if len(samples) < 20:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * p / 100.0))]
+
+    def failed(self, host):
+        with self._lock:
+            self._down_until[host] = time.time() + self.retry_interval
+
+    def latencies(self):
+        "Returns a dict of each replica to its average latency and whether it's up"
+        now = time.time()
+        with self._lock:
+            return dict([(h, (self._latency[h], self._down_until.get(h, 0) <= now))
+                         for h in self.replicas])
+
+def get_router():
+    """Get the router of searches to replicas, or None if there aren't any
+    replicas in the config"""
+    global router
+
+    if router is None:
+        replicas = [h.strip() for h in config.get('ldap', 'replicas').split(",") if h.strip()]
+        if len(replicas) == 0:
+            return None
+
+        router = ReplicaRouter( config.get('ldap', 'host'),
+                                replicas,
+                                probe_interval = config.getint('ldap', 'replica_probe_interval'),
+                                retry_interval = config.getint('ldap', 'replica_retry_interval') )
+    return router
+
+# Errors after which a search is retried on another server
+_FAILOVER_ERRORS = (ldap.SERVER_DOWN, ldap.CONNECT_ERROR, ldap.UNAVAILABLE, ldap.BUSY, ldap.TIMEOUT)
+
+def _wrote():
+    "Note that this thread has just written to the master"
+    _local.last_write = time.time()
+
+def _read_master():
+    "Whether this thread's searches need to go to the master, to see its writes"
+    if getattr(_local, 'consistent', 0) > 0 or getattr(_local, 'conn', None) is not None:
+        return True
+
+    last_write = getattr(_local, 'last_write', None)
+    return last_write is not None and \
+        time.time() - last_write < config.getfloat('ldap', 'read_after_write')
+
+@contextlib.contextmanager
+def consistent():
+    """Context manager within which this thread's searches go to the master,
+    so they see every write which has been made to it"""
+    _local.consistent = getattr(_local, 'consistent', 0) + 1
+    try:
+        yield
+    finally:
+        _local.consistent -= 1
+
+@contextlib.contextmanager
+def deadline(seconds):
+    """Context manager within which this thread's directory calls must all
+    finish within ``seconds``, after which they raise ldap.TIMEOUT. A nested
+    deadline can only shorten the one around it."""
+    outer = getattr(_local, 'deadline', None)
+    end = time.time() + seconds
+    _local.deadline = end if outer is None else min(outer, end)
+    try:
+        yield
+    finally:
+        _local.deadline = outer
+
+def call_timeout():
+    """The time (in seconds) the next directory call may take, from the
+    [ldap] timeout and any deadline() it's within, or -1 for no limit.
+    Raises ldap.TIMEOUT if the deadline has passed."""
+    limit = config.getfloat('ldap', 'timeout')
+    timeout = limit if limit > 0 else None
+
+    end = getattr(_local, 'deadline', None)
+    if end is not None:
+        remaining = end - time.time()
+        if remaining <= 0:
+            raise ldap.TIMEOUT({'desc': "Deadline exceeded"})
+        timeout = remaining if timeout is None else min(timeout, remaining)
+
+    return -1 if timeout is None else timeout
+
+def _checkout_timeout():
+    "How long to wait for a connection from a pool"
+    timeout = call_timeout()
+    return None if timeout < 0 else timeout
+
+def _invoke(conn, name, args, kwargs):
+    "Call a method of a connection, limited to the time left for the call"
+    timeout = call_timeout()
+
+    # search_st takes its own timeout; the other synchronous methods use this
+    if name == "search_st" and kwargs.get("timeout", -1) == -1 and len(args) < 6:
+        kwargs = dict(kwargs, timeout = timeout)
+    conn.timeout = timeout
+
+    return getattr(conn, name)(*args, **kwargs)
+
+def _call(name, args, kwargs):
+    """Call a method on a connection to the master. If the connection has
+    been lost, a new one is opened and the call retried, up to the [ldap]
+    retries times; writes are only retried if they weren't sent, as they
+    might have been made before the connection went."""
+    retries = config.getint('ldap', 'retries')
+    pinned = getattr(_local, 'conn', None) is not None
+    attempt = 0
+
+    while True:
+        sent = False
+        try:
+            with _connection() as conn:
+                sent = True
+                return _invoke(conn, name, args, kwargs)
+        except ldap.SERVER_DOWN:
+            if pinned or attempt >= retries or (sent and name not in READS):
+                raise
+
+        attempt += 1
+        timeout = call_timeout()
+        time.sleep( 0.1 * attempt if timeout < 0 else min(0.1 * attempt, timeout) )
+
+def _read_from(r, host, name, args, kwargs):
+    "Run a search on the given host, recording how long a replica took"
+    if host == r.master:
+        return _call(name, args, kwargs)
+
+    start = time.time()
+    try:
+        with get_replica_pool(host).connection(_checkout_timeout()) as conn:
+            result = _invoke(conn, name, args, kwargs)
+    except _FAILOVER_ERRORS:
+        r.failed(host)
+        raise
+
+    r.record(host, time.time() - start)
+    return result
+
+def _read(name, args, kwargs):
+    "Run a search, on a replica if there's one to use"
+    r = get_router()
+    if r is None or _read_master():
+        return _call(name, args, kwargs)
+
+    percentile = config.getfloat('ldap', 'hedge_percentile')
+    if percentile > 0:
+        threshold = r.percentile(percentile)
+        if threshold is not None:
+            return _hedged_read(r, threshold, name, args, kwargs)
+
+    return _failover_read(r, name, args, kwargs)
+
+def _failover_read(r, name, args, kwargs):
+    """Run a search on the best replica, trying the others in turn if it
+    fails, and then the master, whose errors are left to the caller"""
+    for attempt in range(len(r.replicas)):
+        call_timeout()
+        host = r.choose()
+        if host == r.master:
+            break
+
+        try:
+            return _read_from(r, host, name, args, kwargs)
+        except _FAILOVER_ERRORS:
+            continue
+
+    return _call(name, args, kwargs)
+
+def _hedged_read(r, threshold, name, args, kwargs):
+    """Run a search on the fastest server, and if it hasn't answered within
+    ``threshold`` seconds, on another as well, returning whichever answers
+    first. If they both fail, the search fails over as an unhedged one would."""
+    results = queue.Queue()
+    end = getattr(_local, 'deadline', None)
+
+    def run(host):
+        _local.deadline = end
+        try:
+            results.put( (None, _read_from(r, host, name, args, kwargs)) )
+        except Exception as e:
+            results.put( (e, None) )
+
+    def start(host):
+        hosts.append(host)
+        t = threading.Thread(target = run, args = (host,), name = "srusers-hedge")
+        t.daemon = True
+        t.start()
+
+    hosts = []
+    first = r.choose()
+    if first == r.master:
+        # None of the replicas are up, so there's nothing to hedge with
+        return _call(name, args, kwargs)
+
+    start(first)
+    try:
+        error, result = results.get(timeout = threshold)
+        pending = 0
+    except queue.Empty:
+        start( r.choose(exclude = [first]) )
+        error, result = results.get()
+        pending = 1
+
+    if error is not None and pending > 0:
+        # The other one might still succeed
+        error, result = results.get()
+
+    if error is None:
+        return result
+    if isinstance(error, _FAILOVER_ERRORS) and r.master not in hosts:
+        # The servers which failed are marked down, so this tries the others
+        return _failover_read(r, name, args, kwargs)
+    raise error
+
+@contextlib.contextmanager
+def _read_connection():
+    """Context manager giving a connection for a series of searches, to a
+    replica if possible. It's always checked out for this caller alone, rather
+    than being the one pinned to the thread, as a paged search may hold it
+    while the thread starts other searches."""
+    r = get_router()
+    host = None
+    if r is not None and not _read_master():
+        host = r.choose()
+
+    if host is None or host == r.master:
+        with get_pool().connection(_checkout_timeout()) as conn:
+            yield conn
+        return
+
+    try:
+        with get_replica_pool(host).connection(_checkout_timeout()) as conn:
+            yield conn
+    except _FAILOVER_ERRORS:
+        r.failed(host)
+        raise
+
+def get_auth_pool():
+    """Get the pool of connections used to check users' credentials,
+    creating it if needed. These are never bound as the admin user."""
+    global auth_pool
+
+    if auth_pool is None:
+        auth_pool = ConnectionPool( connect,
+                                    size = config.getint('ldap', 'auth_pool_size'),
+                                    idle_timeout = config.getint('ldap', 'pool_idle_timeout'),
+                                    check_interval = config.getint('ldap', 'pool_check_interval') )
+    return auth_pool
+
+class AuthRequest(object):
+    """A check of a user's credentials which has been sent to the server,
+    but whose result might not have arrived yet. Its connection is returned
+    to the pool once result() has the answer, or when the request is
+    dropped without it being read."""
 
+    def __init__(self, dn, password):
+        self._pool = get_auth_pool()
+        self._conn = None
+        self._result = None
+
+        self._conn = self._pool.checkout(_checkout_timeout())
+        try:
+            self._msgid = self._conn.simple_bind( dn, password )
+        except ldap.LDAPError as e:
+            self.__finish(e)
+
+    def result(self, timeout = None):
+        """Wait for the result of the check. Returns True if the credentials
+        are valid, or raises ldap.TIMEOUT if ``timeout`` seconds (by default
+        the [ldap] timeout, or what's left of the deadline) pass first."""
+        if self._result is not None:
+            return self._result
+
+        if timeout is None:
+            timeout = call_timeout()
+
+        try:
+            self._conn.result3( self._msgid, all = 1, timeout = timeout )
+        except ldap.TIMEOUT:
+            self.__abandon()
+            self._result = False
+            raise
+        except ldap.LDAPError as e:
+            self.__finish(e)
+        else:
+            self.__finish(None)
+
+        return self._result
+
+    def __del__(self):
+        if self._conn is not None:
+            try:
+                self.__abandon()
+            except Exception:
+                pass
+
+    def __abandon(self):
+        "Give up on the check, discarding the connection as its result may still come"
+        conn = self._conn
+        self._conn = None
+        try:
+            conn.abandon( self._msgid )
+        except ldap.LDAPError:
+            pass
+        self._pool.discard(conn)
+
+    def __finish(self, error):
+        conn = self._conn
+        self._conn = None
+        if isinstance(error, ldap.SERVER_DOWN):
+            self._pool.discard(conn)
+        else:
+            self._pool.checkin(conn)
+
+        # Most likely errors are INVALID_CREDENTIALS and UNWILLING_TO_PERFORM
+        # The latter occurs for empty passwords, which we don't allow
+        self._result = error is None
+
+def authenticate_async(dn, password):
+    """Start checking the password for the given dn, without waiting for the
+    server to respond. Returns an object whose result() method gives whether
+    the password is correct (an AuthRequest for the LDAP backend)."""
+    return get_backend().authenticate_async( dn, ensure_text(password) )
+
+def authenticate(dn, password):
+    """Check the password for the given dn. This uses a separate set of
+    connections from the admin ones, which are left bound."""
+    return authenticate_async( dn, password ).result()
+
+_local = threading.local()
+
+@contextlib.contextmanager
+def connection():
+    """Context manager which provides a single connection from the pool.
+    Use this when several operations need to happen on the same connection
+    (for example, ones which use message ids); nested uses in the same thread
+    get the same connection."""
+    with _connection() as conn:
+        yield metrics.instrument(conn)
+
+@contextlib.contextmanager
+def _connection():
+    conn = getattr(_local, 'conn', None)
+    if conn is not None:
+        yield conn
+        return
+
+    with get_backend().connection() as conn:
+        _local.conn = conn
+        try:
+            yield conn
+        finally:
+            _local.conn = None
+
+def pipeline(starts, max_in_flight = 50):
+    """Run several operations on one connection, sending each without
+    waiting for the previous ones to finish.
+    Args: starts = a list of functions, each of which is given the
+                   connection, starts an operation and returns its msgid
+          max_in_flight = the most operations to have outstanding at once
+    Returns a list of the error raised by each operation (None for success)."""
+    errors = [None] * len(starts)
+    in_flight = collections.deque()
+
+    with connection() as conn:
+        def collect():
+            index, msgid = in_flight.popleft()
+            try:
+                conn.result3( msgid, all = 1, timeout = call_timeout() )
+            except ldap.LDAPError as e:
+                errors[index] = e
+
+        for index, start in enumerate(starts):
+            if len(in_flight) >= max_in_flight:
+                collect()
+
+            try:
+                in_flight.append( (index, start(conn)) )
+            except ldap.LDAPError as e:
+                errors[index] = e
+
+        while len(in_flight) > 0:
+            collect()
+
+    # Treat these as writes, so searches which follow see them
+    _wrote()
+    return errors
+
+def paged_search(base, scope, filterstr, attrlist = None, page_size = None):
+    """Generator of the (dn, attrs) of the entries matching a search, which
+    fetches them a page at a time using the Simple Paged Results control.
+    This keeps a connection checked out of the pool until it finishes."""
+    if page_size is None:
+        page_size = config.getint('ldap', 'page_size')
+
+    # Delayed import, as ldap.controls loads pyasn1, which is slow to import
+    from ldap.controls import SimplePagedResultsControl
+
+    control = SimplePagedResultsControl( True, size = page_size, cookie = '' )
+
+    with get_backend().read_connection() as conn:
+        conn = metrics.instrument(conn)
+        while True:
+            msgid = conn.search_ext( base, scope, filterstr, attrlist,
+                                     serverctrls = [control] )
+            rtype, rdata, rmsgid, serverctrls = conn.result3( msgid, timeout = call_timeout() )
+
+            for entry in rdata:
+                yield entry
+
+            cookie = None
+            for ctrl in serverctrls:
+                if ctrl.controlType == SimplePagedResultsControl.controlType:
+                    cookie = ctrl.cookie
+
+            if not cookie:
+                break
+            control.cookie = cookie
+
+# The LDAP Transactions extension (RFC 5805)
+TXN_START_OID = "1.3.6.1.1.21.1"
+TXN_SPEC_OID = "1.3.6.1.1.21.2"
+TXN_END_OID = "1.3.6.1.1.21.3"
+
+def _ber_length(n):
+    "BER encode the length of a value"
+    if n < 0x80:
+        return bytes(bytearray([n]))
+
+    octets = []
+    while n > 0:
+        octets.insert(0, n & 0xff)
+        n >>= 8
+    return bytes(bytearray([0x80 | len(octets)] + octets))
+
+def _end_txn_value(txn_id, commit):
+    "The value of the request to commit or abort a transaction"
+    # SEQUENCE { commit BOOLEAN DEFAULT TRUE, identifier OCTET STRING }
+    body = b"" if commit else b"\x01\x01\x00"
+    body += b"\x04" + _ber_length(len(txn_id)) + txn_id
+    return b"\x30" + _ber_length(len(body)) + body
+
+def _supports_transactions(conn):
+    "Whether the server advertises support for RFC 5805 transactions"
+    try:
+        res = conn.search_st( "", ldap.SCOPE_BASE, "(objectClass=*)",
+                              attrlist = ["supportedExtension"] )
+    except ldap.LDAPError:
+        return False
+
+    if len(res) == 0:
+        return False
+    return TXN_START_OID in ensure_text(res[0][1].get("supportedExtension", []))
+
+class BatchError(Exception):
+    """Raised at the end of a batch() block when some of its writes failed.
+    failures is a list of the (dn, exception) of each of them."""
+
+    def __init__(self, failures):
+        Exception.__init__(self, "%i of the batched writes failed: %s"
+                           % ( len(failures), ", ".join([dn for dn, e in failures]) ))
+        self.failures = failures
+
+class Batch(object):
+    """Writes queued by the users and groups saved or deleted within a
+    batch() block, which are sent together when it ends.
+
+    A second write to an entry by the same object replaces the one already
+    queued for it (objects build their modlists from what they last wrote,
+    so it includes the earlier changes), unless it's re-adding a deleted
+    entry. Otherwise, as separate objects each only send their own changes,
+    it's sent after the writes already queued for the entry."""
+
+    def __init__(self, max_in_flight = 50, transaction = False):
+        self.max_in_flight = max_in_flight
+        self.transaction = transaction
+        # Whether the writes were made in a transaction
+        self.transactional = False
+        self.failures = []
+        # Lists of dn -> (kind, dn, start, done, owner), each sent after the last
+        self._waves = [collections.OrderedDict()]
+
+    def __len__(self):
+        return sum([len(w) for w in self._waves])
+
+    def add(self, dn, modlist, done = None):
+        self.__queue( "add", dn, lambda conn, ctrls: conn.add_ext( dn, modlist, serverctrls = ctrls ), done )
+
+    def modify(self, dn, modlist, done = None):
+        self.__queue( "modify", dn, lambda conn, ctrls: conn.modify_ext( dn, modlist, serverctrls = ctrls ), done )
+
+    def delete(self, dn, done = None):
+        self.__queue( "delete", dn, lambda conn, ctrls: conn.delete_ext( dn, serverctrls = ctrls ), done )
+
+    def submit(self):
+        """Send the queued writes, calling the done function of each which
+        succeeds. Returns the list of (dn, exception) of those which failed."""
+        results = []
+
+        with connection() as conn:
+            ctrls = None
+            txn_id = None
+            if self.transaction and _supports_transactions(conn):
+                # Delayed import, as ldap.controls loads pyasn1, which is slow to import
+                from ldap.controls import RequestControl
+                from ldap.extop import ExtendedRequest
+
+                txn_id = conn.extop_s( ExtendedRequest( TXN_START_OID ) )[1]
+                ctrls = [RequestControl( TXN_SPEC_OID, True, txn_id )]
+                self.transactional = True
+
+            for wave in self._waves:
+                writes = list(wave.values())
+                starts = [self.__starter(start, ctrls) for kind, dn, start, done, owner in writes]
+                results.extend( zip( writes, pipeline( starts, self.max_in_flight ) ) )
+
+            if txn_id is not None:
+                results = self.__end_transaction( conn, txn_id, results )
+
+        self._waves = [collections.OrderedDict()]
+        for (kind, dn, start, done, owner), error in results:
+            if error is not None:
+                self.failures.append( (dn, error) )
+            elif done is not None:
+                done()
+
+        return self.failures
+
+    def __queue(self, kind, dn, start, done):
+        key = dn.lower()
+        # The object making the write, whose method is called when it's done
+        owner = getattr(done, "__self__", None)
+
+        # The last wave with a write to this entry
+        last = None
+        for i, wave in enumerate(self._waves):
+            if key in wave:
+                last = i
+
+        if last is not None:
+            queued = self._waves[last][key]
+            if owner is not None and queued[4] is owner \
+                    and not (queued[0] == "delete" and kind != "delete"):
+                self._waves[last][key] = (kind, dn, start, done, owner)
+                return
+
+            if last + 1 == len(self._waves):
+                self._waves.append(collections.OrderedDict())
+            self._waves[last + 1][key] = (kind, dn, start, done, owner)
+            return
+
+        self._waves[-1][key] = (kind, dn, start, done, owner)
+
+    def __starter(self, start, ctrls):
+        return lambda conn: start( conn, ctrls )
+
+    def __end_transaction(self, conn, txn_id, results):
+        "Commit the transaction if every write succeeded, otherwise abort it"
+        # Delayed import, as with the controls in submit
+        from ldap.extop import ExtendedRequest
+
+        commit = len([e for w, e in results if e is not None]) == 0
+
+        try:
+            conn.extop_s( ExtendedRequest( TXN_END_OID, _end_txn_value( txn_id, commit ) ) )
+        except ldap.LDAPError as e:
+            return [(w, error or e) for w, error in results]
+
+        if not commit:
+            aborted = Exception("Transaction aborted as another write in it failed")
+            return [(w, error or aborted) for w, error in results]
+        return results
+
+@contextlib.contextmanager
+def batch(max_in_flight = 50, transaction = False):
+    """Context manager which queues the writes made by saving or deleting
+    users and groups, then sends them together, without waiting for each
+    in turn, when the block ends. Nothing is sent if the block raises, and
+    reads made within the block don't see the queued writes.
+    Args: max_in_flight = the most writes to have outstanding at once
+          transaction = make the writes in a transaction (RFC 5805), so
+                        either all or none of them happen, if the server
+                        supports it
+    Raises BatchError if any of the writes fail. Nested uses join the
+    outermost batch."""
+    b = getattr(_local, 'batch', None)
+    if b is not None:
+        yield b
+        return
+
+    b = Batch( max_in_flight, transaction )
+    _local.batch = b
+    try:
+        yield b
+    finally:
+        _local.batch = None
+
+    if len(b.submit()) > 0:
+        raise BatchError(b.failures)
+
+def current_batch():
+    "The Batch of the batch() block this thread is in, or None"
+    return getattr(_local, 'batch', None)
+
+# The methods which only read, so can go to a replica, and those which write
+READS = set(["search_s", "search_st", "search_ext_s", "compare_s"])
+WRITES = set(["add_s", "modify_s", "delete_s", "passwd_s", "rename_s", "modrdn_s"])
+
+class PooledConnection(object):
+    """Stands in for a single LDAP connection, but runs each method call on
+    a connection checked out of the pool, with searches going to a replica
+    if any are configured."""
+
+    def __getattr__(self, name):
+        def call(*args, **kwargs):
+            if name in READS:
+                return _read(name, args, kwargs)
+
+            try:
+                return _call(name, args, kwargs)
+            finally:
+                if name in WRITES:
+                    _wrote()
+        call.__name__ = str(name)
+        return call
+
+class LDAPBackend(object):
+    """The backend which talks to an LDAP server, using the connection pool.
+
+    A backend provides the methods of python-ldap's LDAPObject which srusers
+    uses (search_st, add_s, modify_s, delete_s, passwd_s and so on), each run
+    on a connection from the pool, plus:
+      bind(who, cred): check and start using the admin credentials
+      unbind(): stop using them
+      connection(): context manager giving a single connection, which also
+                    supports the msgid based calls (search_ext, result3 etc.)
+      read_connection(): the same, but only used for searches, so it may be
+                    to a replica
+      open_connection() / close_connection(conn): a connection for long
+                    term use by one caller
+      authenticate_async(dn, password): start checking a user's password"""
+
+    def __init__(self):
+        self._pooled = PooledConnection()
+
+    def __getattr__(self, name):
+        return getattr(self._pooled, name)
+
+    def bind(self, who, cred):
+        _clear_pools()
+        pool = get_pool()
+
+        # Check the credentials by opening the first connection of the pool
+        conn = pool.checkout()
+        pool.checkin(conn)
+
+    def unbind(self):
+        _clear_pools()
+
+    def connection(self):
+        return get_pool().connection(_checkout_timeout())
+
+    def read_connection(self):
+        return _read_connection()
+
+    def open_connection(self):
+        return _new_conn()
+
+    def close_connection(self, conn):
+        _close(conn)
+
+    def authenticate_async(self, dn, password):
+        return AuthRequest( dn, password )
+
+def get_backend():
+    """Get the backend which directory operations go to, creating it if
+    needed according to the "backend" option in the config"""
+    global backend
+
+    if backend is None:
+        name = config.get('ldap', 'backend')
+        if name == "ldap":
+            backend = LDAPBackend()
+        elif name == "memory":
+            # Delayed import, as it's rarely used
+            from .memory import MemoryBackend
+            try:
+                rootpw = config.get('ldap', 'password')
+            except NoOptionError:
+                rootpw = None
+            backend = MemoryBackend( rootdn = _admin_dn(), rootpw = rootpw )
+        else:
+            raise Exception("Unknown backend '%s'" % (name))
+
+    return backend
+
+def set_backend(b):
+    "Use the given backend for all directory operations"
+    global backend, bound
+    backend = b
+    bound = False
+
+def _admin_dn():
+    "The dn of the user in the config which srusers binds as"
     # Annoyance: all SR users are under the ou=users subtree, except for
     # the Manager entity, which isn't a user. Work around this corner case.
     username = config.get('ldap', 'username')
     if username == "Manager":
-        conn_str = "cn={0},o=sr".format(username)
+        return "cn={0},o=sr".format(username)
     else:
-        conn_str = "uid={0},ou=users,o=sr".format(username)
+        return "uid={0},ou=users,o=sr".format(username)
+
+def default_pass():
+    try:
+        passwd = config.get('ldap', 'password')
+    except NoOptionError:
+        sys.stderr.write("LDAP Password:")
+        passwd = getpass.getpass("")
 
-    return (conn_str, ensure_text(passwd))
+    return (_admin_dn(), ensure_text(passwd))
 
 user_callback = default_pass
 
@@ -65,21 +1025,24 @@ def set_userinfo( fn ):
     user_callback = fn
 
 def unbind():
-    global conn, bound
+    global bound, credentials
 
     if bound:
-        conn.unbind_s()
         bound = False
-        connect()
+        credentials = None
+        get_backend().unbind()
 
 def bind():
-    global bound, conn, user_callback
+    global bound, credentials, user_callback
 
     if not bound:
         info = user_callback()
+        credentials = (info[0], info[1])
+
         try:
-            conn.simple_bind_s( info[0], info[1] )
+            get_backend().bind( info[0], info[1] )
         except ldap.INVALID_CREDENTIALS:
+            credentials = None
             print("Incorrect password")
             return False
 
@@ -87,5 +1050,5 @@ def bind():
         return True
 
 def get_conn():
-    global conn
-    return conn
+    "The backend, with the calls made through it recorded by metrics"
+    return metrics.instrument(get_backend())
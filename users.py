@@ -3,36 +3,102 @@ from __future__ import unicode_literals
 import base64
 import hashlib
 import ldap
+import os
 import re
-import random
 import string
-from unidecode import unidecode
+from ldap.filter import escape_filter_chars
 
+from . import allocator
+from . import cache
 from . import constants
+from . import membership
+from . import mirror
+from . import roster
 from . import sr_ldap
 from .sr_ldap import ensure_bytes, ensure_text, get_conn
 
+PASSWORD_CHARS = string.ascii_letters + string.digits
+
+def generate_passwords(count, length = 8):
+    "Generate count random passwords, from the system's secure random source"
+    # Bytes from here up are skipped, so that each character is equally likely
+    limit = 256 - (256 % len(PASSWORD_CHARS))
+    needed = count * length
+
+    chars = []
+    while len(chars) < needed:
+        # Read a bit extra, to make up for the skipped bytes
+        for b in bytearray(os.urandom( (needed - len(chars)) * 5 // 4 + 8 )):
+            if b < limit:
+                chars.append(PASSWORD_CHARS[b % len(PASSWORD_CHARS)])
+
+    return ["".join(chars[i * length:(i + 1) * length]) for i in range(count)]
+
 def GenPasswd():
-    chars = string.ascii_letters + string.digits
-    newpasswd = ""
-    for i in range(8):
-        newpasswd = newpasswd + random.choice(chars)
-    return newpasswd
+    return generate_passwords(1)[0]
+
+def encode_pass(p, salted = False):
+    "Hash a password for userPassword, as {SHA}, or {SSHA} if it's to be salted"
+    if salted:
+        salt = os.urandom(8)
+        h = hashlib.sha1(ensure_bytes(p) + salt)
+        return '{SSHA}%s' %( base64.b64encode( h.digest() + salt ).decode('utf-8') )
 
-def encode_pass(p):
     h = hashlib.sha1(ensure_bytes(p))
     return '{SHA}%s' %( base64.b64encode( h.digest() ).decode('utf-8') )
 
 def list():
+    m = mirror.active()
+    if m is not None:
+        return _uids(m.user_entries())
+
+    return [username for username in iter_list()]
+
+def iter_list(page_size = None):
+    "Generator of the usernames of all the users, fetched a page at a time"
     sr_ldap.bind()
 
-    u_res = get_conn().search_st( "ou=users,o=sr",
-                                  ldap.SCOPE_ONELEVEL,
-                                  filterstr = "(objectClass=inetOrgPerson)",
-                                  attrlist = ["uid"] )
-    users = ensure_text([x[1]["uid"][0] for x in u_res])
+    for dn, attrs in sr_ldap.paged_search( "ou=users,o=sr",
+                                           ldap.SCOPE_ONELEVEL,
+                                           "(objectClass=inetOrgPerson)",
+                                           attrlist = ["uid"],
+                                           page_size = page_size ):
+        yield ensure_text(attrs["uid"][0])
+
+def iter_users(attrlist = None, page_size = None):
+    """Generator of user objects for all the users, fetched a page at a time.
+    If attrlist is given only those attributes are fetched (see user.__init__)."""
+    sr_ldap.bind()
 
-    return users
+    attrlist = user._attrlist(attrlist)
+    for dn, attrs in sr_ldap.paged_search( "ou=users,o=sr",
+                                           ldap.SCOPE_ONELEVEL,
+                                           "(objectClass=inetOrgPerson)",
+                                           attrlist = attrlist,
+                                           page_size = page_size ):
+        yield user._from_entry(dn, attrs, attrlist)
+
+def iter_records(page_size = None):
+    """Generator of read-only user_records for all the users, fetched a page
+    at a time. These are much smaller and quicker to make than user objects."""
+    m = mirror.active()
+    if m is not None:
+        for dn, attrs in m.user_entries():
+            yield user_record._from_entry(dn, attrs)
+        return
+
+    sr_ldap.bind()
+
+    for dn, attrs in sr_ldap.paged_search( "ou=users,o=sr",
+                                           ldap.SCOPE_ONELEVEL,
+                                           "(objectClass=inetOrgPerson)",
+                                           attrlist = user_record.attrlist,
+                                           page_size = page_size ):
+        yield user_record._from_entry(dn, attrs)
+
+def _uids(res):
+    "Extract the usernames from the results of a search"
+    return ensure_text([x[1]["uid"][0] for x in res])
 
 def new_username(college_id, first_name, last_name, tmpset = []):
     """
@@ -43,11 +109,32 @@ def new_username(college_id, first_name, last_name, tmpset = []):
     @param last_name: the last name of the user
     @param tmpset: a collection of user names that are not valid
     """
+    prefix = _username_prefix(college_id, first_name, last_name)
+
+    def c(i):
+        return "%s%i" % (prefix, i)
+
+    # Find all the existing names with this prefix in one go, rather than
+    # checking each candidate name against the database in turn
+    taken = set([u.lower() for u in usernames_with_prefix(prefix)])
+    taken.update([ensure_text(u).lower() for u in tmpset])
+
+    n = 1
+    while c(n) in taken:
+        n += 1
+
+    return c(n)
+
+def _username_prefix(college_id, first_name, last_name):
+    "The start of the usernames for a user, which new_username adds a number to"
     if college_id.startswith(constants.COLLEGE_PREFIX):
         college_tla = college_id[len(constants.COLLEGE_PREFIX):]
     else:
         college_tla = college_id
 
+    # Delayed import, as it's slow and only needed for new users
+    from unidecode import unidecode
+
     def first_letter(name):
         # unidecode expects a ``unicode`` not a ``str`` otherwise weird results occur
         uname = ensure_text(name)
@@ -60,31 +147,300 @@ def new_username(college_id, first_name, last_name, tmpset = []):
     first = first_letter(first_name)
     last = first_letter(last_name)
     prefix = "%s_%s%s" % (ensure_text(college_tla), first[0], last[0])
-    prefix = prefix.lower()
+    return prefix.lower()
 
-    def c(i):
-        return "%s%i" % (prefix, i)
+def usernames_with_prefix(prefix):
+    "Returns a list of the usernames which start with the given prefix"
+    return _usernames_with_prefixes([prefix])
 
-    n = 1
-    u = user( c(n), match_case = False )
+def _usernames_with_prefixes(prefixes):
+    "Returns a list of the usernames which start with any of the given prefixes"
+    sr_ldap.bind()
 
-    while u.in_db or u.username in tmpset:
-        n += 1
-        u = user( c(n), match_case = False )
+    filter_template = "(&(objectClass=inetOrgPerson)(|{0}))"
+    usernames = []
+    for i in range(0, len(prefixes), LOAD_CHUNK_SIZE):
+        chunk = prefixes[i:i + LOAD_CHUNK_SIZE]
+        parts = "".join(["(uid={0}*)".format(escape_filter_chars(ensure_text(p))) for p in chunk])
+        u_res = get_conn().search_st( "ou=users,o=sr",
+                                      ldap.SCOPE_ONELEVEL,
+                                      filterstr = filter_template.format(parts),
+                                      attrlist = ["uid"] )
+        usernames.extend(_uids(u_res))
+
+    return usernames
+
+def create(college_id, first_name, last_name, email):
+    """
+    Creates a new user, with a username picked by new_username. It's safe
+    to run at the same time as other creates: if the username is taken in
+    the meantime, the next free one is picked instead. (Within a batch()
+    the add isn't sent until the batch ends, so this can't happen.)
+    @param college_id: either the group name or TLA of the college
+    @param first_name: the first name of the user
+    @param last_name: the last name of the user
+    @param email: the user's email address
+    @return: the new user, whose init_passwd is its initial password
+    """
+    taken = []
+    uidNumber = None
+
+    for attempt in range(ADD_ATTEMPTS):
+        u = user._new( new_username(college_id, first_name, last_name, taken) )
+        u.cname = first_name
+        u.sname = last_name
+        u.email = email
+        if uidNumber is not None:
+            # Keep the id allocated for the first attempt
+            u.props["uidNumber"] = uidNumber
+
+        try:
+            u.save()
+            return u
+        except ldap.ALREADY_EXISTS:
+            if attempt + 1 == ADD_ATTEMPTS:
+                raise
+            taken.append(u.username)
+            uidNumber = u.props["uidNumber"]
+
+def bulk_create(records, college, teams = []):
+    """
+    Creates many new users at once, with a handful of searches for the
+    whole batch rather than several per user. It's safe to run at the same
+    time as other bulk_creates: if a username it picks is taken in the
+    meantime, it picks another.
+    @param records: a list of dicts with "first_name", "last_name" and
+                    "email" keys, plus optionally "groups": a list of extra
+                    groups for that user to be added to
+    @param college: the group name of the college the users are from, which
+                    they're added to and their usernames are based on
+    @param teams: a list of groups that all of the users are added to
+    @return: a list of dicts, one per record, with the "username" and
+             initial "password" of the new user, and the exception for
+             any "error" creating it or adding it to its groups (or None)
+    """
+    # Delayed import to avoid circular dependency
+    from . import groups
+
+    sr_ldap.bind()
+
+    results = [{"username": None, "password": None, "error": None} for r in records]
+    if len(records) == 0:
+        return results
+
+    prefixes = [_username_prefix(college, r["first_name"], r["last_name"]) for r in records]
+    uidNumbers = _uid_allocator.allocate_block(len(records))
+
+    new_users = [None] * len(records)
+    errors = [None] * len(records)
+    pending = [i for i in range(len(records))]
+
+    for attempt in range(ADD_ATTEMPTS):
+        # Pick all the usernames from one set of prefix searches
+        taken = set([u.lower() for u in _usernames_with_prefixes(sorted(set([prefixes[i] for i in pending])))])
+
+        for i in pending:
+            n = 1
+            while "%s%i" % (prefixes[i], n) in taken:
+                n += 1
+            username = "%s%i" % (prefixes[i], n)
+            taken.add(username)
+
+            u = user._new(username)
+            u.cname = records[i]["first_name"]
+            u.sname = records[i]["last_name"]
+            u.email = records[i]["email"]
+            u.props["uidNumber"] = ensure_text(str(uidNumbers[i]))
+            new_users[i] = u
+
+        # Send all the adds without waiting for each in turn
+        starts = [_add_starter(new_users[i].dn, new_users[i]._prepare_save()[1]) for i in pending]
+        for i, error in zip(pending, sr_ldap.pipeline(starts)):
+            errors[i] = error
+
+        # Someone else took some of the usernames in the meantime, so pick again
+        pending = [i for i in pending if isinstance(errors[i], ldap.ALREADY_EXISTS)]
+        if len(pending) == 0:
+            break
+
+    group_members = {}
+    for record, u, error, result in zip(records, new_users, errors, results):
+        result["username"] = u.username
+        if error is not None:
+            result["error"] = error
+            continue
+
+        u._saved()
+        cache.invalidate_user(u.username)
+        result["password"] = u.init_passwd
+
+        gnames = [college]
+        gnames.extend(teams)
+        gnames.extend(record.get("groups", []))
+
+        for gname in gnames:
+            group_members.setdefault(gname, []).append( (u, result) )
+
+    # Then change each group once
+    for gname, members in group_members.items():
+        g = groups.group(gname)
+        if not g.in_db:
+            for u, result in members:
+                result["error"] = Exception("Group '%s' doesn't exist" % (gname))
+            continue
+
+        try:
+            g.user_add([u for u, result in members])
+            g.save()
+        except ldap.LDAPError as e:
+            for u, result in members:
+                result["error"] = e
+
+    return results
+
+# Number of times create and bulk_create try to add a user, picking another
+# username each time the one picked was taken by someone else at the same time
+ADD_ATTEMPTS = 5
+
+def bulk_reset_passwords(target, salted = False):
+    """
+    Gives many users new random passwords at once, finding them with a few
+    searches and sending the changes without waiting for each in turn.
+    @param target: a list of usernames, or a group (its name or a
+                   groups.group) whose members' passwords are all reset
+    @param salted: store the passwords as salted ({SSHA}) hashes
+    @return: a list of dicts, one per user, with the "username", new
+             "password" and the exception for any "error" setting it (or
+             None); see credentials_table to print them
+    """
+    # Delayed import to avoid circular dependency
+    from . import groups
+
+    sr_ldap.bind()
 
-    return u.username
+    if isinstance(target, groups.group):
+        usernames = target.members
+    # Can't just use "list" as we've got our own function of that name above
+    elif type(target) is not type([]):
+        g = groups.group(target)
+        if not g.in_db:
+            raise Exception("Group '%s' doesn't exist" % (target))
+        usernames = g.members
+    else:
+        usernames = target
+
+    found, missing = user.load_many(usernames, attrs = ["username"])
+    passwords = generate_passwords(len(found))
+
+    starts = []
+    for u, p in zip(found, passwords):
+        modlist = [(ldap.MOD_REPLACE, "userPassword", ensure_bytes(encode_pass( p, salted )))]
+        starts.append(_modify_starter(u.dn, modlist))
+    errors = sr_ldap.pipeline(starts)
+
+    results = {}
+    for u, p, error in zip(found, passwords, errors):
+        cache.invalidate_user(u.username)
+        results[u.username.lower()] = { "username": u.username,
+                                        "password": p if error is None else None,
+                                        "error": error }
+    for username in missing:
+        results[username.lower()] = { "username": username,
+                                      "password": None,
+                                      "error": Exception("User '%s' doesn't exist" % (username)) }
+
+    return [results[ensure_text(u).lower()] for u in usernames]
+
+def credentials_table(results):
+    "Format the results of bulk_create or bulk_reset_passwords as a table for printing"
+    rows = [("Username", "Password")]
+    for r in results:
+        if r["password"] is not None:
+            rows.append( (r["username"] or "", r["password"]) )
+        else:
+            rows.append( (r["username"] or "", "ERROR: %s" % (r["error"])) )
 
-def _load(username, match_case):
+    width = max([len(name) for name, password in rows])
+    return "\n".join(["%s  %s" % (name.ljust(width), password) for name, password in rows])
+
+def lang_from_groups(group_names):
+    "Return the language given by the lang- group in a list of groups, if any"
+    for group in group_names:
+        m = re.match( "^lang-(.+)$", group )
+        if m != None:
+            return m.groups()[0]
+
+def _add_starter(dn, modlist):
+    "A function which starts adding the given entry, for sr_ldap.pipeline"
+    return lambda conn: conn.add_ext( dn, modlist )
+
+def _modify_starter(dn, modlist):
+    "A function which starts modifying the given entry, for sr_ldap.pipeline"
+    return lambda conn: conn.modify_ext( dn, modlist )
+
+def _load(username, match_case, attrlist = None):
     username = ensure_text(username)
+
+    # Only whole entries are cached, but they can answer any projection
+    key = cache.user_key(username, match_case)
+    found, info = cache.get_cache().get(key)
+    if found:
+        return info
+
     filter_template = "(&(objectClass=inetOrgPerson)(uid:{0}:={1}))"
     filter_case = 'caseExactMatch' if match_case else 'caseIgnoreMatch'
     info =  get_conn().search_st( "ou=users,o=sr",
                               ldap.SCOPE_ONELEVEL,
-                              filterstr = filter_template.format(filter_case, username) )
+                              filterstr = filter_template.format(filter_case, username),
+                              attrlist = attrlist )
+
+    if attrlist is None:
+        cache.get_cache().put(key, info)
 
     return info
 
-class user:
+_uid_allocator = allocator.IdAllocator( 2000, "uidNumber",
+                                        "ou=users,o=sr",
+                                        "(objectClass=inetOrgPerson)" )
+
+# Maximum number of usernames to put in a single search filter
+LOAD_CHUNK_SIZE = 100
+
+def _load_many(usernames, match_case, attrlist = None):
+    """Search for the entries of several users, in as few searches as possible.
+    If attrlist is given only those attributes are fetched."""
+    filter_template = "(&(objectClass=inetOrgPerson)(|{0}))"
+    part_template = "(uid:{0}:={1})"
+    filter_case = 'caseExactMatch' if match_case else 'caseIgnoreMatch'
+
+    info = []
+    to_search = []
+    for username in usernames:
+        found, cached = cache.get_cache().get(cache.user_key(username, match_case))
+        if found:
+            info.extend(cached)
+        else:
+            to_search.append(username)
+
+    for i in range(0, len(to_search), LOAD_CHUNK_SIZE):
+        chunk = to_search[i:i + LOAD_CHUNK_SIZE]
+        parts = "".join([part_template.format(filter_case, escape_filter_chars(u)) for u in chunk])
+        res = get_conn().search_st( "ou=users,o=sr",
+                                    ldap.SCOPE_ONELEVEL,
+                                    filterstr = filter_template.format(parts),
+                                    attrlist = attrlist )
+        info.extend(res)
+
+        if attrlist is not None:
+            continue
+
+        for dn, attrs in res:
+            username = ensure_text(attrs["uid"][0])
+            cache.get_cache().put(cache.user_key(username, match_case), [(dn, attrs)])
+
+    return info
+
+class user(object):
     """A user"""
     map = { "cname" : "cn",
           "sname" : "sn",
@@ -99,92 +455,213 @@ class user:
                        "gidNumber" ]
 
     @classmethod
-    def search(cls, **kwargs):
+    def _search_filter(cls, **kwargs):
+        "Build the filter used by search(), or None if there's nothing to search on"
         parts = []
         for common, prop in cls.map.items():
             if common in kwargs:
                 val = kwargs[common]
-                sval = ensure_text(val)
+                sval = escape_filter_chars("%s" % ensure_text(val))
                 parts.append("({0}={1})".format(prop, sval))
 
         if len(parts) == 0:
             return None
 
         parts = ["(objectClass=inetOrgPerson)"] + parts
+        return "(&{0})".format("".join(parts))
+
+    @classmethod
+    def _attrlist(cls, attrs):
+        """The attributes to fetch for a projection onto the given properties
+        (such as "cname", or the attribute name "cn"), or None for them all"""
+        if attrs is None:
+            return None
+
+        attrlist = set(["uid"])
+        for name in attrs:
+            attrlist.add( cls.map.get(name, name) )
+        return sorted(attrlist)
+
+    @classmethod
+    def search(cls, attrs = None, **kwargs):
+        """Find the users whose properties have the given values.
+        Returns their usernames, or if attrs is given, user objects with
+        those properties fetched by the same search (see __init__)."""
+        filter_str = cls._search_filter(**kwargs)
+        if filter_str is None:
+            return None
+
+        m = mirror.active()
+        if m is not None:
+            criteria = dict((prop, kwargs[common]) for common, prop in cls.map.items()
+                            if common in kwargs)
+            result = m.search_users(criteria)
+            if attrs is None:
+                return _uids(result)
+            return [cls._from_entry(dn, a) for dn, a in result]
+
         sr_ldap.bind()
 
-        filter_str = "(&{0})".format("".join(parts))
+        attrlist = cls._attrlist(attrs)
+        result = get_conn().search_st("ou=users,o=sr",
+                                      ldap.SCOPE_ONELEVEL,
+                                      filterstr = filter_str,
+                                      attrlist = attrlist or ["uid"])
+
+        if attrs is None:
+            return _uids(result)
+        return [cls._from_entry(dn, a, attrlist) for dn, a in result]
+
+    @classmethod
+    def search_records(cls, **kwargs):
+        "Like search(), but returns read-only user_records of the users"
+        filter_str = cls._search_filter(**kwargs)
+        if filter_str is None:
+            return None
+
+        m = mirror.active()
+        if m is not None:
+            criteria = dict((prop, kwargs[common]) for common, prop in cls.map.items()
+                            if common in kwargs)
+            return [user_record._from_entry(dn, a) for dn, a in m.search_users(criteria)]
+
+        sr_ldap.bind()
 
         result = get_conn().search_st("ou=users,o=sr",
                                       ldap.SCOPE_ONELEVEL,
                                       filterstr = filter_str,
-                                      attrlist = ["uid"])
+                                      attrlist = user_record.attrlist)
+        return [user_record._from_entry(dn, a) for dn, a in result]
 
-        userids = ensure_text([item[1][u'uid'][0] for item in result])
-        return userids
+    @classmethod
+    def load_records(cls, usernames, match_case = False):
+        """Like load_many(), but gives read-only user_records of the users.
+        Returns a tuple of the records found and the usernames which weren't."""
+        found, missing = cls.load_many(usernames, match_case, attrs = user_record.attrlist)
+        return ([user_record._from_user(u) for u in found], missing)
+
+    @classmethod
+    def load_many(cls, usernames, match_case = False, attrs = None):
+        """Load several users at once, using a few searches rather than one
+        per user, optionally fetching only some properties (see __init__).
+        Returns a tuple of the list of users which were found and the list
+        of usernames which weren't."""
+        sr_ldap.bind()
+
+        usernames = [ensure_text(u) for u in usernames]
+        attrlist = cls._attrlist(attrs)
+        info = _load_many(usernames, match_case, attrlist)
+
+        def key(username):
+            return username if match_case else username.lower()
+
+        entries = {}
+        for dn, attrs in info:
+            entries[key(ensure_text(attrs["uid"][0]))] = (dn, attrs)
+
+        found = []
+        missing = []
+        for username in usernames:
+            entry = entries.get(key(username))
+            if entry is None:
+                missing.append(username)
+            else:
+                found.append(cls._from_entry(entry[0], entry[1], attrlist))
+
+        return (found, missing)
+
+    @classmethod
+    def _from_entry(cls, dn, attrs, attrlist = None):
+        """Create a user from an entry returned by a search, without searching
+        again. attrlist is the attributes the search fetched, if not all."""
+        u = cls.__new__(cls)
+        u.changed_props = []
+        u.in_db = True
+        u.__set_entry(dn, attrs, attrlist)
+        return u
 
     @classmethod
     def exists(cls, username, match_case=False):
-        info = _load(username, match_case)
+        sr_ldap.bind()
+        info = _load(username, match_case, attrlist = ["uid"])
         return info != None and len(info) == 1
 
-    def __init__( self, username, match_case = False ):
-        """Initialise the user object"""
+    @classmethod
+    def _new(cls, username):
+        "Create a user which isn't in the database, without checking whether it is"
+        u = cls.__new__(cls)
+        u.changed_props = []
+        u._fetched = None
+        u.__init_new( ensure_text(username) )
+        return u
+
+    def __init__( self, username, match_case = False, attrs = None ):
+        """Initialise the user object.
+        If attrs is given, only those properties (e.g. ["cname", "email"])
+        are fetched; the first use of any other fetches the rest of them."""
         sr_ldap.bind()
 
         self.changed_props = []
+        self._fetched = None
 
         username = ensure_text(username)
-        if not self.__load( username, match_case ):
-            uidNumber = self.__get_new_uidNumber()
-
-            self.init_passwd = GenPasswd()
+        if not self.__load( username, match_case, self._attrlist(attrs) ):
+            self.__init_new( username )
+        else:
+            self.in_db = True
 
-            self.props = { "uid" : username,
-                           "objectClass" : ['inetOrgPerson', 'uidObject', 'posixAccount'],
-                           "uidNumber" : ensure_text(str(uidNumber)),
-                           "gidNumber" : "1999",
-                           "homeDirectory" : "/home/%s" % ( username ),
-                           "userPassword" : encode_pass( self.init_passwd ),
-                           "loginShell" : "/bin/bash"
-                           }
-            self.dn = "uid=%s,ou=users,o=sr" % (username)
+    def __init_new( self, username ):
+        # The uidNumber is only allocated when the user is first saved
+        self.init_passwd = GenPasswd()
 
-            #All properties are new
-            self.changed_props = self.props.keys()
+        self.props = { "uid" : username,
+                       "objectClass" : ['inetOrgPerson', 'uidObject', 'posixAccount'],
+                       "gidNumber" : "1999",
+                       "homeDirectory" : "/home/%s" % ( username ),
+                       "userPassword" : encode_pass( self.init_passwd ),
+                       "loginShell" : "/bin/bash"
+                       }
+        self.dn = "uid=%s,ou=users,o=sr" % (username)
 
-            self.in_db = False
+        #All properties are new
+        self.changed_props = self.props.keys()
 
-        else:
-            self.in_db = True
+        self.in_db = False
 
-    def __load( self, username, match_case ):
-        info = _load( username, match_case )
+    def __load( self, username, match_case, attrlist = None ):
+        info = _load( username, match_case, attrlist )
 
         if len(info) == 1:
-            self.dn = info[0][0]
-            self.props = {k: ensure_text(v) for k, v in info[0][1].items()}
+            self.__set_entry(info[0][0], info[0][1], attrlist)
             return True
         else:
             return False
 
+    def __set_entry(self, dn, attrs, attrlist = None):
+        # The values are decoded when they're used
+        self.dn = dn
+        self.props = dict(attrs)
+        self._fetched = None if attrlist is None else set(attrlist)
 
-    def __get_new_uidNumber( self ):
-        """Finds the next available UID"""
-        users = get_conn().search_st( "ou=users,o=sr",
-                                  ldap.SCOPE_ONELEVEL,
-                                  filterstr = "(objectClass=inetOrgPerson)",
-                                  attrlist = ["uidNumber"] )
-        uids = []
+    def __unfetched(self, prop):
+        "Whether the given attribute wasn't fetched when the user was loaded"
+        fetched = self.__dict__.get("_fetched")
+        return fetched is not None and prop not in fetched and self.in_db
 
-        for uid in [int(x[1]["uidNumber"][0]) for x in users]:
-            uids.append(uid)
+    def __fetch_rest(self):
+        "Fetch the attributes which weren't loaded, in one search"
+        info = _load( ensure_text(self.props["uid"][0]), True )
+        self._fetched = None
 
-        uid = 2000
-        while uid in uids:
-            uid += 1
+        if len(info) == 1:
+            for prop, val in info[0][1].items():
+                if prop not in self.changed_props:
+                    self.props[prop] = val
 
-        return uid
+
+    def __get_new_uidNumber( self ):
+        """Finds the next available UID"""
+        return _uid_allocator.allocate()
 
     def __set_prop(self, pname, val):
         self.props[pname] = ensure_text(val)
@@ -200,49 +677,97 @@ class user:
             self.__dict__[name] = val
 
     def save(self):
-        self.__check()
+        is_new, modlist = self._prepare_save()
 
-        if self.in_db:
-            return self.__update()
+        if not is_new and len(modlist) == 0:
+            # Nothing has changed
+            return True
+
+        batch = sr_ldap.current_batch()
+        if batch is not None:
+            # Written when the batch ends
+            if is_new:
+                batch.add( self.dn, modlist, self.__written )
+            else:
+                batch.modify( self.dn, modlist, self.__written )
+            return True
+
+        if is_new:
+            get_conn().add_s( self.dn, modlist )
         else:
-            return self.__save_new()
+            get_conn().modify_s( self.dn, modlist )
+
+        self.__written()
+        return True
+
+    def __written(self):
+        cache.invalidate_user(self.username)
+        roster.invalidate_user(self.username)
+        self._saved()
 
     def delete(self):
         """Deletes the user with the specified username"""
 
         if not self.in_db:
             raise Exception("Cannot delete user '%s' - doesn't exist in database" % (self.username))
-        else:
-            get_conn().delete_s( self.dn )
-            self.in_db = False
+
+        batch = sr_ldap.current_batch()
+        if batch is not None:
+            batch.delete( self.dn, self.__deleted )
             return True
 
-    def __save_new(self):
-        """Save the user as a new item in the database"""
-        modlist = []
-        for prop in self.props:
-            modlist.append( (prop, ensure_bytes(self.props[prop])) )
+        get_conn().delete_s( self.dn )
+        self.__deleted()
+        return True
+
+    def __deleted(self):
+        cache.invalidate_user(self.username)
+        roster.invalidate_user(self.username)
+        self.in_db = False
 
-        get_conn().add_s( self.dn, modlist )
+    def _prepare_save(self):
+        """Check the user can be saved, and build the modlist to do so.
+        Returns a tuple of whether the user is new, and the modlist."""
+        self.__check()
+
+        if not self.in_db and "uidNumber" not in self.props:
+            self.props["uidNumber"] = ensure_text(str(self.__get_new_uidNumber()))
 
+        if self.in_db:
+            return (False, self.__update_modlist())
+        else:
+            return (True, self.__new_modlist())
+
+    def _saved(self):
+        "Record that the changes to the user have been written to the database"
         self.in_db = True
         self.changed_props = []
 
-        return True
+    def __new_modlist(self):
+        """The modlist to add the user as a new item in the database"""
+        modlist = []
+        for prop in self.props:
+            modlist.append( (prop, ensure_bytes(self.props[prop])) )
+
+        return modlist
 
-    def __update(self):
-        """Update the user in the database"""
+    def __update_modlist(self):
+        """The modlist to update the user in the database"""
         modlist = []
         for prop in self.changed_props:
             modlist.append( (ldap.MOD_REPLACE, prop, ensure_bytes(self.props[prop])) )
 
-        get_conn().modify_s( self.dn, modlist )
-        self.changed_props = []
-        return True
+        return modlist
 
     def __missing_props(self):
         """Get a collection of the properties that are missing from this user"""
         required = set(self.required_props)
+        if not self.in_db:
+            # This is allocated when the user is first saved
+            required.discard("uidNumber")
+        elif self._fetched is not None:
+            # The others weren't loaded, so can't have been removed
+            required &= self._fetched
         actual = set(self.props.keys())
         missing = required - actual
         return missing
@@ -256,6 +781,9 @@ class user:
 
     def __getattr__(self, name):
         if name in self.map.keys():
+            if self.map[name] not in self.props and self.__unfetched(self.map[name]):
+                self.__fetch_rest()
+
             if self.map[name] in self.props.keys():
                 pval = self.props[ self.map[name] ]
 
@@ -280,7 +808,8 @@ class user:
               "Home directory" : "homeDirectory" }
         first = True
 
-        self.props
+        if self._fetched is not None:
+            self.__fetch_rest()
 
         for human, z in p.items():
             if first:
@@ -293,6 +822,7 @@ class user:
                 # Can't just use "list" as we've got our own function of that name above
                 if type(pval) is type([]):
                     pval = pval[0]
+                pval = ensure_text(pval)
             else:
                 pval = "None"
 
@@ -302,34 +832,37 @@ class user:
 
     def groups(self):
         """Returns a list of the groups the user is in"""
+        m = mirror.active()
+        if m is not None:
+            return m.groups_of(self.username)
 
-        filter =  "(&(objectClass=posixGroup)(memberUid=%s))" % ( self.username )
-
-        res = get_conn().search_st( "ou=groups,o=sr",
-                                ldap.SCOPE_ONELEVEL,
-                                filterstr=filter,
-                                attrlist=["cn"] )
+        return membership.get_index().groups_of(self.username)
 
-        lgroups = ensure_text([x[1]["cn"][0] for x in res])
+    def _groups_filter(self):
+        """The filter which finds the groups the user is in, including those
+        (such as shell-users) which list their members by dn"""
+        # Delayed import to avoid circular dependency
+        from . import groups
 
-        return lgroups
+        return "(&(objectClass=posixGroup)(|(memberUid=%s)(memberUid=%s)))" \
+            % ( escape_filter_chars(self.username),
+                escape_filter_chars(groups.uname_to_dn(self.username)) )
 
     def bind(self,p):
+        "Check whether the given password is correct for this user"
         if self.in_db:
-            sr_ldap.unbind()
+            return sr_ldap.authenticate( self.dn, p )
 
-            try:
-                get_conn().bind_s( self.dn, ensure_text(p) )
-            except ldap.LDAPError:
-                # Most likely are INVALID_CREDENTIALS and UNWILLING_TO_PERFORM
-                # The latter occurs for empty passwords, which we don't allow
-                return False
-
-            return True
+    def bind_async(self,p):
+        """Start checking whether the given password is correct for this user.
+        Returns an sr_ldap.AuthRequest, or None if the user isn't in the database."""
+        if self.in_db:
+            return sr_ldap.authenticate_async( self.dn, p )
 
     def __mod_passwd(self,p):
         modlist = [(ldap.MOD_REPLACE, "userPassword", ensure_bytes(encode_pass( p )) )]
         get_conn().modify_s( self.dn, modlist )
+        cache.invalidate_user(self.username)
         return True
 
     def set_passwd(self,old = None,new = None):
@@ -341,6 +874,7 @@ class user:
             return self.__mod_passwd(new)
         else:
             get_conn().passwd_s( self.dn, ensure_bytes(old), ensure_bytes(new) )
+            cache.invalidate_user(self.username)
             return True
 
     def get_lang(self):
@@ -348,11 +882,7 @@ class user:
         if not self.in_db:
             raise Exception( "Cannot discover language of user who's not in the DB" )
 
-        g = self.groups()
-        for group in g:
-            m = re.match( "^lang-(.+)$", group )
-            if m != None:
-                return m.groups()[0]
+        return lang_from_groups( self.groups() )
 
     def set_lang(self, lang):
         "Set the language of the user"
@@ -374,3 +904,177 @@ class user:
         assert g.in_db
         g.user_add( self )
         g.save()
+
+        cache.invalidate_user(self.username)
+
+class user_record(object):
+    """A read-only snapshot of a user's properties (the ones in user.map,
+    as text, or None if the user doesn't have them), for listing many users
+    at once. Use to_user() to get a user object which can be changed."""
+
+    __slots__ = ("dn",) + tuple(sorted(user.map.keys()))
+
+    # The attributes to fetch to fill in a record
+    attrlist = sorted(set(user.map.values()))
+
+    @classmethod
+    def _from_entry(cls, dn, attrs):
+        r = cls.__new__(cls)
+        object.__setattr__(r, "dn", ensure_text(dn))
+        for name, prop in user.map.items():
+            values = attrs.get(prop)
+            object.__setattr__(r, name, ensure_text(values[0]) if values else None)
+        return r
+
+    @classmethod
+    def _from_user(cls, u):
+        return cls._from_entry(u.dn, u.props)
+
+    def __setattr__(self, name, val):
+        raise AttributeError("user_record is read-only; use to_user() to make changes")
+
+    def __repr__(self):
+        return "<user_record %s>" % (self.username)
+
+    def to_user(self):
+        """A user object for this user, to make changes to it. Properties
+        which aren't in the record are fetched when they're first used."""
+        attrs = {}
+        for name, prop in user.map.items():
+            val = getattr(self, name)
+            if val is not None:
+                attrs[prop] = [ensure_bytes(val)]
+
+        return user._from_entry(self.dn, attrs, self.attrlist)
+
+def _sort_control(ordering):
+    "A server side sort control (RFC 2891), or None if python-ldap can't make one"
+    try:
+        # Delayed import, as it needs pyasn1
+        from ldap.controls.sss import SSSRequestControl
+    except ImportError:
+        return None
+
+    # Not critical, as the results are sorted again here anyway
+    return SSSRequestControl( criticality = False, ordering_rules = ordering )
+
+class query(object):
+    """A search for users on the properties in user.map, for example:
+
+        users.query().prefix(username = "abc_").contains(cname = "smith") \
+                     .sort("sname", "cname").limit(50).records()
+
+    The values are escaped, so can safely come from user input. The results
+    are fully populated from the one search."""
+
+    def __init__(self):
+        self._parts = []
+        self._sizelimit = 0
+        self._timelimit = -1
+        self._sort = []
+        # Whether the last run stopped at the size or time limit
+        self.truncated = False
+
+    def exact(self, **kwargs):
+        "Match users whose properties equal the given values"
+        return self.__add( "({0}={1})", kwargs )
+
+    def prefix(self, **kwargs):
+        "Match users whose properties start with the given values"
+        return self.__add( "({0}={1}*)", kwargs )
+
+    def contains(self, **kwargs):
+        "Match users whose properties contain the given values"
+        return self.__add( "({0}=*{1}*)", kwargs )
+
+    def limit(self, count):
+        "Return at most count users"
+        self._sizelimit = count
+        return self
+
+    def timeout(self, seconds):
+        "Give up on the search (returning what's been found) after this long"
+        self._timelimit = seconds
+        return self
+
+    def sort(self, *names):
+        """Order the results by the given properties, each prefixed with "-"
+        to sort by it in descending order. The server does the sorting if it
+        can, so that a limit() gives the first users in that order."""
+        for name in names:
+            self.__prop( name.lstrip("-") )
+        self._sort = [(name.lstrip("-"), name.startswith("-")) for name in names]
+        return self
+
+    def filter(self):
+        return "(&(objectClass=inetOrgPerson){0})".format( "".join(self._parts) )
+
+    def usernames(self):
+        return _uids( self.__run(["uid"] + self.__sort_attrs()) )
+
+    def records(self):
+        "The matching users, as read-only user_records"
+        return [user_record._from_entry(dn, attrs) for dn, attrs in self.__run(user_record.attrlist)]
+
+    def users(self):
+        "The matching users, as user objects"
+        return [user._from_entry(dn, attrs) for dn, attrs in self.__run(None)]
+
+    def __prop(self, name):
+        if name not in user.map:
+            raise Exception( "Users have no property '%s'" % (name) )
+        return user.map[name]
+
+    def __add(self, template, kwargs):
+        for name, val in sorted(kwargs.items()):
+            prop = self.__prop(name)
+            self._parts.append( template.format(prop, escape_filter_chars("%s" % ensure_text(val))) )
+        return self
+
+    def __sort_attrs(self):
+        return [user.map[name] for name, descending in self._sort]
+
+    def __run(self, attrlist):
+        sr_ldap.bind()
+        self.truncated = False
+
+        ctrls = []
+        if len(self._sort) > 0:
+            ctrl = _sort_control( [("-" if descending else "") + user.map[name]
+                                   for name, descending in self._sort] )
+            if ctrl is not None:
+                ctrls.append(ctrl)
+
+        results = []
+        with sr_ldap.connection() as conn:
+            msgid = conn.search_ext( "ou=users,o=sr",
+                                     ldap.SCOPE_ONELEVEL,
+                                     self.filter(),
+                                     attrlist,
+                                     serverctrls = ctrls,
+                                     timeout = self._timelimit,
+                                     sizelimit = self._sizelimit )
+            try:
+                while True:
+                    rtype, rdata, rmsgid, rctrls = conn.result3( msgid, all = 0,
+                                                                 timeout = sr_ldap.call_timeout() )
+                    if rtype in (ldap.RES_SEARCH_ENTRY, ldap.RES_SEARCH_RESULT):
+                        results.extend(rdata)
+                    if rtype == ldap.RES_SEARCH_RESULT:
+                        break
+            except (ldap.SIZELIMIT_EXCEEDED, ldap.TIMELIMIT_EXCEEDED):
+                self.truncated = True
+            except ldap.TIMEOUT:
+                conn.abandon(msgid)
+                self.truncated = True
+
+        if self._sizelimit > 0 and len(results) >= self._sizelimit:
+            self.truncated = True
+
+        # Sort here too, in case the server doesn't support sorting
+        for name, descending in reversed(self._sort):
+            prop = user.map[name]
+            results.sort( key = lambda r: ensure_text(r[1].get(prop, [b""])[0]).lower(),
+                          reverse = descending )
+
+        return results